@@ -0,0 +1,12 @@
+# vim: fdm=indent
+'''
+author:     Fabio Zanini
+date:       17/10/26
+content:    Entry point for python -m pysang, which skips the pkg_resources
+            import of the setuptools launcher.
+'''
+# Script
+if __name__ == '__main__':
+
+    from pysang.command_line import main
+    main()
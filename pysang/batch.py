@@ -0,0 +1,210 @@
+# vim: fdm=indent
+'''
+author:     Fabio Zanini
+date:       17/10/26
+content:    Headless processing of many ABI files in parallel.
+'''
+# Modules
+import os
+import sys
+import csv
+import json
+from collections import OrderedDict
+from multiprocessing import Pool, cpu_count
+
+from parser import parse_abi, _abi_trim, AbiFile, _EXTRACT
+import profiling
+
+
+# Globals
+# tags needed for sequence output, traces are never read
+_SEQUENCE_TAGS = ('PBAS2', 'PCON2', 'SMPL1')
+# columns of scan results, see scan_file
+scan_fields = ['filename', 'sample_id'] + sorted(_EXTRACT.values()) + \
+        ['run_start', 'run_finish', 'error']
+
+
+
+# Functions
+def find_abi_files(dirname):
+    '''Sorted list of ABI files in a folder'''
+    return sorted(os.path.join(dirname, fn) for fn in os.listdir(dirname)
+                  if os.path.splitext(fn)[1].lower() in ('.ab1', '.abi'))
+
+
+def available_cores():
+    '''Number of cores this process may run on'''
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return cpu_count()
+
+
+def _parse_sequence(args):
+    '''Parse the called sequence of one file, errors are returned not raised
+
+    With profile, the spans recorded while parsing are returned in the result
+    (and dropped from this process) so they can be merged by the caller.
+    '''
+    (filename, trim, cache, profile) = args
+    if profile:
+        profiling.enable()
+    try:
+        if cache is not None:
+            seq = parse_abi(filename, trim=False, cache=cache)
+        else:
+            seq = parse_abi(filename, trim=False, tags=_SEQUENCE_TAGS)
+        if trim:
+            seq = _abi_trim(seq)
+        result = {'filename': filename,
+                  'name': seq.name,
+                  'id': seq.id,
+                  'seq': str(seq.seq),
+                  'qual': list(seq.letter_annotations['phred_quality']),
+                  'error': None}
+    except Exception as err:
+        result = {'filename': filename,
+                  'error': '%s: %s' % (err.__class__.__name__, err)}
+    if profile:
+        result['profile'] = profiling.snapshot()
+        profiling.reset()
+    return result
+
+
+def iter_sequences(filenames, trim=False, processes=None, cache=None,
+                   profile=False):
+    '''Parse called sequences of many files in a process pool.
+
+    Results are dicts with filename, name, id, seq, qual and error, yielded
+    in input order as soon as they are ready. A file that cannot be parsed
+    yields a result with the error message instead of raising. With a
+    RecordCache, full records are cached and read back from it. With
+    profile, the spans recorded by the workers are merged into the profiling
+    summary of this process.
+    '''
+    tasks = [(filename, trim, cache, profile) for filename in filenames]
+    for result in imap_ordered(_parse_sequence, tasks, processes):
+        yield _merge_profile(result)
+
+
+def imap_ordered(func, tasks, processes=None, chunksize=16,
+                 initializer=None, initargs=()):
+    '''Map func over tasks in a process pool, yielding results in order.
+
+    initializer(*initargs) is called once in each worker process, or in this
+    process if there are no workers.
+    '''
+    if processes is None:
+        processes = available_cores()
+
+    if processes <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for task in tasks:
+            yield func(task)
+        return
+
+    chunksize = max(1, min(chunksize, len(tasks) // (4 * processes)))
+    pool = Pool(processes, initializer=initializer, initargs=initargs)
+    try:
+        for result in pool.imap(func, tasks, chunksize):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _merge_profile(result):
+    if 'profile' in result:
+        profiling.merge(result.pop('profile'))
+    return result
+
+
+def format_sequence(result, fmt='fasta'):
+    '''Format a parsed sequence as a FASTA or FASTQ entry'''
+    header = result['name']
+    if result['id'] and result['id'] != result['name']:
+        header += ' ' + result['id']
+
+    if fmt == 'fasta':
+        return '>%s\n%s\n' % (header, result['seq'])
+    elif fmt == 'fastq':
+        qual = ''.join(chr(min(q, 93) + 33) for q in result['qual'])
+        return '@%s\n%s\n+\n%s\n' % (header, result['seq'], qual)
+    else:
+        raise ValueError('Format not supported: '+str(fmt))
+
+
+def write_sequences(filenames, out, fmt='fasta', trim=False, processes=None,
+                    cache=None, err=sys.stderr, profile=False):
+    '''Write the called sequences of many files, return the number of errors'''
+    n_errors = 0
+    for result in iter_sequences(filenames, trim=trim, processes=processes,
+                                 cache=cache, profile=profile):
+        if result['error'] is not None:
+            n_errors += 1
+            err.write('pysang: cannot parse %s: %s\n' % (result['filename'],
+                                                         result['error']))
+            continue
+        out.write(format_sequence(result, fmt=fmt))
+    return n_errors
+
+
+def scan_file(filename):
+    '''Sample and run metadata of one file, errors are returned not raised
+
+    Only the header, the directory and the few small tags needed are read,
+    traces and base calls are never touched.
+    '''
+    result = OrderedDict((field, None) for field in scan_fields)
+    result['filename'] = filename
+    try:
+        with AbiFile(filename) as abi:
+            result['sample_id'] = abi.get('SMPL1')
+            for (key, name) in _EXTRACT.iteritems():
+                result[name] = abi.get(key)
+            for (field, number) in (('run_start', 1), ('run_finish', 2)):
+                run_date = abi.get('RUND'+str(number))
+                run_time = abi.get('RUNT'+str(number))
+                if (run_date is not None) or (run_time is not None):
+                    result[field] = ' '.join(x for x in (run_date, run_time)
+                                              if x is not None)
+    except Exception as err:
+        result['error'] = '%s: %s' % (err.__class__.__name__, err)
+    return result
+
+
+def iter_scans(filenames, processes=None):
+    '''Scan the metadata of many files in a process pool, see scan_file.
+
+    Results are yielded in input order. Small tasks are batched per worker,
+    so the scan is bound by metadata I/O rather than by process overhead.
+    '''
+    return imap_ordered(scan_file, filenames, processes=processes,
+                        chunksize=256)
+
+
+def write_scans(filenames, out, fmt='csv', processes=None):
+    '''Write the metadata of many files as CSV or JSON, return the number of errors'''
+    if fmt not in ('csv', 'json'):
+        raise ValueError('Format not supported: '+str(fmt))
+
+    n_errors = 0
+    if fmt == 'csv':
+        writer = csv.DictWriter(out, scan_fields)
+        writer.writeheader()
+    else:
+        results = []
+    for result in iter_scans(filenames, processes=processes):
+        if result['error'] is not None:
+            n_errors += 1
+        if fmt == 'csv':
+            writer.writerow(result)
+        else:
+            results.append(result)
+
+    if fmt == 'json':
+        json.dump(results, out, indent=1)
+        out.write('\n')
+    return n_errors
@@ -0,0 +1,315 @@
+# vim: fdm=indent
+'''
+author:     Fabio Zanini
+date:       17/10/26
+content:    Benchmarks of the parsing and plotting hot paths on a synthetic
+            ABIF corpus.
+'''
+# Modules
+import os
+import sys
+import time
+import shutil
+import struct
+import resource
+import tempfile
+from multiprocessing import Process, Queue
+
+import numpy as np
+
+from parser import _HEADFMT, _DIRFMT
+
+
+# Globals
+# element codes and sizes, see _BYTEFMT in parser
+_CHAR = (2, 1)
+_SHORT = (4, 2)
+_DATE = (10, 4)
+_TIME = (11, 4)
+_PSTRING = (18, 1)
+# the directory of a real file starts after 128 bytes of header
+_DATA_START = 128
+# clicks per file for closest_peak
+_N_CLICKS = 1000
+
+
+
+# Functions
+def write_synthetic_abi(filename, n_bases=700, n_extra_tags=0, spacing=12,
+                        seed=0):
+    '''Write a synthetic ABIF file with a random read.
+
+    n_bases - length of the base-called read
+    n_extra_tags - number of additional directory entries (XTRA1, XTRA2, ...)
+                   to test large directories
+    spacing - average number of trace samples between peaks
+
+    The file has the tags read by parse_abi: called bases and qualities
+    with low-quality ends, peak positions, analyzed and raw traces with one
+    Gaussian peak per base, channel order, sample name, run dates and times.
+    '''
+    rng = np.random.RandomState(seed)
+    channels = 'GATC'
+
+    seq = rng.choice(list('ACGT'), n_bases)
+    peaks = (20 + spacing * np.arange(n_bases) +
+             rng.randint(-spacing // 4, spacing // 4 + 1, n_bases))
+
+    # high quality in the middle, low at the ends
+    ramp = np.minimum(np.arange(n_bases), np.arange(n_bases)[::-1])
+    qual = np.minimum(rng.randint(20, 62, n_bases),
+                      2 + rng.randint(0, 3, n_bases) + ramp)
+
+    # one Gaussian peak per base in the channel of that base
+    n_samples = peaks[-1] + 20
+    halfwidth = spacing // 2
+    offsets = np.arange(-halfwidth, halfwidth + 1)
+    sigma = spacing / 4.0
+    shapes = (rng.randint(300, 1500, n_bases)[:, np.newaxis] *
+              np.exp(-offsets**2 / (2 * sigma**2)))
+    positions = peaks[:, np.newaxis] + offsets
+    traces = np.zeros((4, n_samples))
+    for (i, base) in enumerate(channels):
+        is_base = seq == base
+        np.add.at(traces[i], positions[is_base], shapes[is_base])
+    traces = traces.clip(0, 32767).astype('>i2')
+
+    tags = [('PBAS', 2, _CHAR, ''.join(seq)),
+            ('PCON', 2, _CHAR, qual.astype('u1').tostring()),
+            ('PLOC', 2, _SHORT, peaks.astype('>i2').tostring()),
+            ('FWO_', 1, _CHAR, channels),
+            ('SMPL', 1, _PSTRING, _pstring('synthetic%d' % seed)),
+            ('TUBE', 1, _PSTRING, _pstring('A1')),
+            ('DySN', 1, _PSTRING, _pstring('Z_BigDyeV3')),
+            ('GTyp', 1, _PSTRING, _pstring('POP7')),
+            ('MODL', 1, _CHAR, '3730'),
+            ('RUND', 1, _DATE, struct.pack('>h2B', 2026, 10, 17)),
+            ('RUND', 2, _DATE, struct.pack('>h2B', 2026, 10, 17)),
+            ('RUNT', 1, _TIME, struct.pack('>4B', 9, 0, 0, 0)),
+            ('RUNT', 2, _TIME, struct.pack('>4B', 10, 30, 0, 0))]
+    for i in xrange(4):
+        tags.append(('DATA', i + 1, _SHORT, traces[i].tostring()))
+        tags.append(('DATA', i + 9, _SHORT, traces[i].tostring()))
+    for i in xrange(n_extra_tags):
+        tags.append(('XTRA', i + 1, _SHORT,
+                     rng.randint(0, 100, 16).astype('>i2').tostring()))
+
+    # data blocks first, then the directory
+    blocks = []
+    directory = []
+    offset = _DATA_START
+    for (name, number, (elem_code, elem_size), data) in tags:
+        if len(data) <= 4:
+            # small data are stored in place of the offset
+            data_offset = struct.unpack('>I', data.ljust(4, '\0'))[0]
+        else:
+            data_offset = offset
+            blocks.append(data)
+            offset += len(data)
+        directory.append(struct.pack(_DIRFMT, name, number, elem_code,
+                                     elem_size, len(data) // elem_size,
+                                     len(data), data_offset, 0))
+
+    entry_size = struct.calcsize(_DIRFMT)
+    header = 'ABIF' + struct.pack(_HEADFMT, 101, 'tdir', 1, 1023, entry_size,
+                                  len(directory), entry_size * len(directory),
+                                  offset)
+    with open(filename, 'wb') as f:
+        f.write(header.ljust(_DATA_START, '\0'))
+        f.write(''.join(blocks))
+        f.write(''.join(directory))
+
+
+def _pstring(text):
+    return chr(len(text)) + text
+
+
+def make_corpus(dirname, n_files=50, n_bases=700, n_extra_tags=0):
+    '''Write n_files synthetic ABIF files in a folder, return their names'''
+    filenames = []
+    for i in xrange(n_files):
+        filename = os.path.join(dirname, 'synthetic_%04d.ab1' % i)
+        write_synthetic_abi(filename, n_bases=n_bases,
+                            n_extra_tags=n_extra_tags, seed=i)
+        filenames.append(filename)
+    return filenames
+
+
+def bench_abi_iterator(filenames, use_mmap=False):
+    from parser import AbiIterator
+
+    n_bases = 0
+    t0 = time.time()
+    for filename in filenames:
+        with open(filename, 'rb') as f:
+            for seq in AbiIterator(f, use_mmap=use_mmap):
+                n_bases += len(seq)
+    return (time.time() - t0, n_bases)
+
+
+def bench_abi_iterator_mmap(filenames):
+    return bench_abi_iterator(filenames, use_mmap=True)
+
+
+def bench_abi_trim(filenames):
+    from parser import parse_abi, _abi_trim
+
+    seqs = [parse_abi(filename, trim=False) for filename in filenames]
+    t0 = time.time()
+    for seq in seqs:
+        _abi_trim(seq)
+    return (time.time() - t0, sum(len(seq) for seq in seqs))
+
+
+def bench_trim_and_rescale_trace(filenames):
+    from parser import parse_abi, trim_and_rescale_trace
+
+    seqs = [parse_abi(filename, trim=False) for filename in filenames]
+    t0 = time.time()
+    for seq in seqs:
+        trim_and_rescale_trace(seq)
+    return (time.time() - t0, sum(len(seq) for seq in seqs))
+
+
+def bench_reverse_complement(filenames, compact=False):
+    from parser import parse_abi
+    from sequence_utils import reverse_complement
+
+    seqs = [parse_abi(filename, compact=compact) for filename in filenames]
+    t0 = time.time()
+    for seq in seqs:
+        reverse_complement(seq)
+    return (time.time() - t0, sum(len(seq) for seq in seqs))
+
+
+def bench_reverse_complement_compact(filenames):
+    return bench_reverse_complement(filenames, compact=True)
+
+
+def bench_closest_peak(filenames):
+    from parser import parse_abi
+    from plot import closest_peak
+
+    seqs = [parse_abi(filename) for filename in filenames]
+    rng = np.random.RandomState(0)
+    clicks = [rng.uniform(0, len(seq), _N_CLICKS).tolist() for seq in seqs]
+    t0 = time.time()
+    for (seq, seq_clicks) in zip(seqs, clicks):
+        for pos_click in seq_clicks:
+            closest_peak(pos_click, seq)
+    return (time.time() - t0, sum(len(seq) for seq in seqs))
+
+
+def bench_plot_chromatograph(filenames):
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from parser import parse_abi
+    from plot import plot_chromatograph
+
+    seqs = [parse_abi(filename) for filename in filenames]
+    fig = Figure(figsize=(16, 6), dpi=100)
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    t0 = time.time()
+    for seq in seqs:
+        ax.clear()
+        plot_chromatograph(seq, ax)
+        canvas.draw()
+    return (time.time() - t0, sum(len(seq) for seq in seqs))
+
+
+benchmarks = [('AbiIterator', bench_abi_iterator),
+              ('AbiIterator (mmap)', bench_abi_iterator_mmap),
+              ('_abi_trim', bench_abi_trim),
+              ('trim_and_rescale_trace', bench_trim_and_rescale_trace),
+              ('reverse_complement', bench_reverse_complement),
+              ('reverse_complement (compact)', bench_reverse_complement_compact),
+              ('closest_peak (%d clicks/file)' % _N_CLICKS, bench_closest_peak),
+              ('plot_chromatograph (Agg)', bench_plot_chromatograph)]
+
+
+def peak_memory():
+    '''Peak resident memory of this process, in bytes'''
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on OS X
+    if sys.platform == 'darwin':
+        return maxrss
+    return maxrss * 1024
+
+
+def _run_in_child(func, filenames, repeat, results):
+    try:
+        (seconds, n_bases) = min(func(filenames) for i in xrange(repeat))
+        results.put((seconds, n_bases, peak_memory(), None))
+    except Exception as err:
+        results.put((None, None, None, '%s: %s' % (err.__class__.__name__, err)))
+
+
+def run_benchmark(func, filenames, repeat=3):
+    '''Time a benchmark in a fresh process, best of repeat runs.
+
+    Returns a dict with seconds, files/s, bases/s and the peak memory of the
+    process running the benchmark, so that each benchmark is measured alone.
+    '''
+    results = Queue()
+    child = Process(target=_run_in_child,
+                    args=(func, filenames, repeat, results))
+    child.start()
+    (seconds, n_bases, memory, error) = results.get()
+    child.join()
+    if error is not None:
+        return {'error': error}
+
+    seconds = max(seconds, 1e-9)
+    return {'seconds': seconds,
+            'files_per_s': len(filenames) / seconds,
+            'bases_per_s': n_bases / seconds,
+            'peak_memory_mb': memory / 2.0**20,
+            'error': None}
+
+
+def run_benchmarks(n_files=50, n_bases=700, n_extra_tags=0, repeat=3,
+                   names=None, dirname=None):
+    '''Run the benchmarks on a synthetic corpus, return a list of results.
+
+    names - restrict to benchmarks whose name starts with one of these
+    dirname - folder for the corpus, a temporary folder by default
+    '''
+    tmpdir = None
+    if dirname is None:
+        dirname = tmpdir = tempfile.mkdtemp(prefix='pysang_benchmark_')
+    elif not os.path.isdir(dirname):
+        os.makedirs(dirname)
+
+    try:
+        filenames = make_corpus(dirname, n_files=n_files, n_bases=n_bases,
+                                n_extra_tags=n_extra_tags)
+        results = []
+        for (name, func) in benchmarks:
+            if (names is not None) and \
+               (not any(name.startswith(prefix) for prefix in names)):
+                continue
+            result = run_benchmark(func, filenames, repeat=repeat)
+            result['name'] = name
+            results.append(result)
+        return results
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+
+
+def format_results(results):
+    '''Table of benchmark results'''
+    lines = ['%-34s %10s %12s %10s %10s' % ('benchmark', 'files/s', 'bases/s',
+                                            'time [s]', 'peak [MB]')]
+    for result in results:
+        if result['error'] is not None:
+            lines.append('%-34s %s' % (result['name'], result['error']))
+        else:
+            lines.append('%-34s %10.1f %12.0f %10.4f %10.1f' %
+                         (result['name'], result['files_per_s'],
+                          result['bases_per_s'], result['seconds'],
+                          result['peak_memory_mb']))
+    return '\n'.join(lines)
@@ -0,0 +1,264 @@
+# vim: fdm=indent
+'''
+author:     Fabio Zanini
+date:       17/10/26
+content:    On-disk cache of parsed ABI files.
+'''
+# Modules
+import os
+import json
+import struct
+import hashlib
+import tempfile
+from time import time
+
+import numpy as np
+
+from parser import _HEADFMT
+from record import ChromatogramRecord, TraceAxis
+
+
+# Globals
+# bump when the layout of the cache entries changes
+_FORMAT_VERSION = 1
+_DEFAULT_MAX_BYTES = 512 * 2**20
+# the folder is rescanned after this many puts even if the running size is
+# below max_bytes, since other processes may write to it too
+_RESCAN_PUTS = 100
+# temporary files older than this (in seconds) were left by killed writers
+_STALE_TMP_AGE = 3600
+
+
+
+# Classes
+class RecordCache(object):
+    '''Size-bounded on-disk cache of parsed ABI files.
+
+    Each parsed file is stored as one uncompressed npz entry with the traces,
+    peaks, qualities and metadata. Entries are keyed by file path, size,
+    mtime and a hash of the ABIF header and directory, so checking an entry
+    reads only the header and the directory block of the file; a file
+    rewritten with the same size, mtime and directory is not detected. The
+    size of the cache is tracked as entries are written; when it grows
+    beyond max_bytes, the folder is rescanned and the least recently used
+    entries are deleted.
+    '''
+
+    def __init__(self, dirname, max_bytes=_DEFAULT_MAX_BYTES):
+        self.dirname = dirname
+        self.max_bytes = max_bytes
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        # estimated size in bytes, None until the folder is scanned
+        self.nbytes = None
+        self._puts = 0
+
+
+    def key(self, filename, trim=True):
+        '''Cache key of a file, None if it cannot be cached'''
+        if not isinstance(filename, basestring):
+            return None
+        try:
+            return _fingerprint(filename, trim=trim)
+        except (IOError, OSError, struct.error):
+            return None
+
+
+    def get(self, filename, trim=True, compact=False):
+        '''Cached record for a file, or None if missing or stale'''
+        key = self.key(filename, trim=trim)
+        if key is None:
+            return None
+
+        path = self._path(key)
+        try:
+            with np.load(path) as entry:
+                seq = _load_record(entry)
+        except Exception:
+            return None
+
+        # mark as recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        if compact:
+            return seq
+        return seq.to_seqrecord()
+
+
+    def put(self, filename, seq, trim=True):
+        '''Store a parsed record, either a SeqRecord or a ChromatogramRecord'''
+        key = self.key(filename, trim=trim)
+        if key is None:
+            return
+
+        if not isinstance(seq, ChromatogramRecord):
+            seq = ChromatogramRecord.from_seqrecord(seq)
+
+        # write to a temporary file and rename, so readers never see
+        # partial entries
+        (fd, tmp_path) = tempfile.mkstemp(dir=self.dirname, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **_dump_record(seq))
+                size = f.tell()
+            os.rename(tmp_path, self._path(key))
+        except (IOError, OSError):
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+
+        # rewritten entries are counted twice until the next scan
+        self._puts += 1
+        if self.nbytes is not None:
+            self.nbytes += size
+        if (self.nbytes is None) or (self.nbytes > self.max_bytes) or \
+           (self._puts >= _RESCAN_PUTS):
+            self.evict()
+
+
+    def evict(self):
+        '''Scan the folder and delete least recently used entries until the
+        cache fits, and temporary files left by killed writers'''
+        entries = []
+        total = 0
+        now = time()
+        for fn in os.listdir(self.dirname):
+            path = os.path.join(self.dirname, fn)
+            if fn.endswith('.tmp'):
+                try:
+                    st = os.stat(path)
+                    if now - st.st_mtime > _STALE_TMP_AGE:
+                        os.remove(path)
+                    else:
+                        total += st.st_size
+                except OSError:
+                    pass
+                continue
+            if not fn.endswith('.npz'):
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+
+        total += sum(size for (_, size, _) in entries)
+        for (_, size, path) in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+        self.nbytes = total
+        self._puts = 0
+
+
+    def clear(self):
+        '''Delete all entries'''
+        for fn in os.listdir(self.dirname):
+            if fn.endswith('.npz'):
+                os.remove(os.path.join(self.dirname, fn))
+        self.nbytes = None
+
+
+    def _path(self, key):
+        return os.path.join(self.dirname, key+'.npz')
+
+
+
+# Functions
+def default_cache():
+    '''Cache in the folder set by PYSANG_CACHE_DIR, or None if unset'''
+    dirname = os.environ.get('PYSANG_CACHE_DIR')
+    if not dirname:
+        return None
+    max_mb = os.environ.get('PYSANG_CACHE_SIZE_MB')
+    if max_mb:
+        return RecordCache(dirname, max_bytes=int(max_mb) * 2**20)
+    return RecordCache(dirname)
+
+
+def _fingerprint(filename, trim=True):
+    '''Hash of path, size, mtime, ABIF header and directory'''
+    filename = os.path.abspath(filename)
+    st = os.stat(filename)
+    with open(filename, 'rb') as f:
+        head = f.read(4 + struct.calcsize(_HEADFMT))
+        header = struct.unpack(_HEADFMT, head[4:])
+        f.seek(header[7])
+        directory = f.read(header[4] * header[5])
+
+    h = hashlib.sha1()
+    h.update('%d %s %d %r %d' % (_FORMAT_VERSION, filename, st.st_size,
+                                 st.st_mtime, trim))
+    h.update(head)
+    h.update(directory)
+    return h.hexdigest()
+
+
+def _dump_record(seq):
+    '''Arrays of a ChromatogramRecord for np.savez'''
+    meta = {'seq': str(seq.seq),
+            'id': seq.id,
+            'name': seq.name,
+            'description': seq.description,
+            'channels': seq.channels,
+            'metadata': seq.metadata}
+    arrays = {'meta': np.array(json.dumps(meta)),
+              'traces': seq.traces,
+              'peaks': seq.peaks,
+              'quality': seq.quality}
+    if isinstance(seq.trace_x, TraceAxis):
+        arrays['trace_axis'] = np.array([seq.trace_x.length,
+                                         seq.trace_x.step,
+                                         seq.trace_x.offset])
+    elif seq.trace_x is not None:
+        arrays['trace_x'] = np.asarray(seq.trace_x)
+    return arrays
+
+
+def _load_record(entry):
+    '''ChromatogramRecord from an npz cache entry'''
+    from Bio.Alphabet.IUPAC import ambiguous_dna, unambiguous_dna
+    from Bio.Seq import Seq
+
+    meta = json.loads(str(entry['meta']), object_hook=_str_values)
+    if set(meta['seq']).intersection('KYWMRS'):
+        alphabet = ambiguous_dna
+    else:
+        alphabet = unambiguous_dna
+
+    # membership tests on the NpzFile itself read every member
+    if 'trace_axis' in entry.files:
+        (length, step, offset) = entry['trace_axis']
+        trace_x = TraceAxis(length, step=step, offset=offset)
+    elif 'trace_x' in entry.files:
+        trace_x = entry['trace_x']
+    else:
+        trace_x = None
+
+    return ChromatogramRecord(Seq(_str(meta['seq']), alphabet),
+                              entry['traces'], entry['peaks'],
+                              entry['quality'], meta['channels'],
+                              trace_x=trace_x,
+                              id=meta['id'], name=meta['name'],
+                              description=meta['description'],
+                              metadata=meta['metadata'])
+
+
+def _str(value):
+    '''Native strings back from json'''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def _str_values(obj):
+    return dict((_str(key), _str(value)) for (key, value) in obj.iteritems())
@@ -9,18 +9,226 @@ import sys
 import argparse as ap
 
 
-def main():
+# Functions
+def main_batch(argv):
+    '''Convert a folder of ABI files to FASTA/FASTQ without the GUI'''
+    parser = ap.ArgumentParser(prog='pysang batch',
+                               description='Convert a folder of ABI files to FASTA/FASTQ',
+                               formatter_class=ap.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('dirname',
+                        help='Folder with the .ab1 files')
+    parser.add_argument('--format', choices=['fasta', 'fastq'], default='fastq',
+                        help='Output format')
+    parser.add_argument('--trim', action='store_true',
+                        help='Trim low quality ends (Mott algorithm)')
+    parser.add_argument('-o', '--output', default='-',
+                        help='Output file, - for stdout')
+    parser.add_argument('-j', '--processes', type=int, default=None,
+                        help='Number of worker processes (default: available cores)')
+    parser.add_argument('--cache', default=None,
+                        help='Folder for the cache of parsed files')
+    parser.add_argument('--profile', nargs='?', const='-', default=None,
+                        metavar='JSON',
+                        help='Time the parsing steps and print a summary to stderr, '+
+                             'or write it to a JSON file')
+
+    args = parser.parse_args(argv)
+
+    from batch import find_abi_files, write_sequences
+    filenames = find_abi_files(args.dirname)
+
+    cache = None
+    if args.cache is not None:
+        from cache import RecordCache
+        cache = RecordCache(args.cache)
+
+    profile = args.profile is not None
+    if args.output == '-':
+        n_errors = write_sequences(filenames, sys.stdout, fmt=args.format,
+                                   trim=args.trim, processes=args.processes,
+                                   cache=cache, profile=profile)
+    else:
+        with open(args.output, 'w') as out:
+            n_errors = write_sequences(filenames, out, fmt=args.format,
+                                       trim=args.trim,
+                                       processes=args.processes,
+                                       cache=cache, profile=profile)
+
+    if args.profile == '-':
+        import profiling
+        sys.stderr.write(profiling.format_summary()+'\n')
+    elif profile:
+        import profiling
+        profiling.dump(args.profile)
+
+    if n_errors:
+        sys.stderr.write('pysang: %d of %d files could not be parsed\n' %
+                         (n_errors, len(filenames)))
+        sys.exit(1)
+
+
+def main_benchmark(argv):
+    '''Time the hot paths on a synthetic corpus of ABI files'''
+    parser = ap.ArgumentParser(prog='pysang benchmark',
+                               description='Time parsing and plotting on synthetic ABI files',
+                               formatter_class=ap.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--files', type=int, default=50,
+                        help='Number of files in the corpus')
+    parser.add_argument('--length', type=int, default=700,
+                        help='Read length in bases')
+    parser.add_argument('--extra-tags', type=int, default=0,
+                        help='Additional directory entries per file')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Repeats per benchmark, the best is reported')
+    parser.add_argument('--only', nargs='+', default=None,
+                        help='Run only benchmarks starting with these names')
+    parser.add_argument('--corpus', default=None,
+                        help='Folder to write the corpus to (kept)')
+    parser.add_argument('--json', default=None,
+                        help='Also write the results to this JSON file')
+
+    args = parser.parse_args(argv)
+
+    from benchmark import run_benchmarks, format_results
+    results = run_benchmarks(n_files=args.files, n_bases=args.length,
+                             n_extra_tags=args.extra_tags,
+                             repeat=args.repeat, names=args.only,
+                             dirname=args.corpus)
+    print format_results(results)
+
+    if args.json is not None:
+        import json
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+def main_render(argv):
+    '''Render chromatograph images of many ABI files without the GUI'''
+    parser = ap.ArgumentParser(prog='pysang render',
+                               description='Render chromatograph images of ABI files',
+                               formatter_class=ap.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('inputs', nargs='+',
+                        help='ABI files or folders with .ab1 files')
+    parser.add_argument('-o', '--outdir', required=True,
+                        help='Folder for the images')
+    parser.add_argument('--format', choices=['png', 'svg', 'pdf'], default='png',
+                        help='Format of the full-size images')
+    parser.add_argument('--peaks', nargs=2, type=int, default=None,
+                        metavar=('START', 'END'),
+                        help='Render only this window of bases')
+    parser.add_argument('--thumbnail-factor', type=int, default=4,
+                        help='Thumbnails are this many times smaller, 0 for none')
+    parser.add_argument('--size', nargs=2, type=float, default=[16, 6],
+                        metavar=('WIDTH', 'HEIGHT'),
+                        help='Figure size in inches')
+    parser.add_argument('--dpi', type=int, default=100,
+                        help='Resolution of the full-size images')
+    parser.add_argument('-j', '--processes', type=int, default=None,
+                        help='Number of worker processes (default: available cores)')
+    parser.add_argument('--cache', default=None,
+                        help='Folder for the cache of parsed files')
+
+    args = parser.parse_args(argv)
+
+    import os
+    from batch import find_abi_files
+    from render import render_files
+    filenames = []
+    for path in args.inputs:
+        if os.path.isdir(path):
+            filenames.extend(find_abi_files(path))
+        else:
+            filenames.append(path)
+
+    cache = None
+    if args.cache is not None:
+        from cache import RecordCache
+        cache = RecordCache(args.cache)
+
+    n_errors = 0
+    for result in render_files(filenames, args.outdir, fmt=args.format,
+                               peaklim=args.peaks,
+                               thumb_factor=args.thumbnail_factor,
+                               width=args.size[0], height=args.size[1],
+                               dpi=args.dpi, processes=args.processes,
+                               cache=cache):
+        if result['error'] is not None:
+            n_errors += 1
+            sys.stderr.write('pysang: cannot render %s: %s\n' %
+                             (result['filename'], result['error']))
+
+    if n_errors:
+        sys.stderr.write('pysang: %d of %d files could not be rendered\n' %
+                         (n_errors, len(filenames)))
+        sys.exit(1)
+
+
+def main_scan(argv):
+    '''Inventory of a folder of ABI files from their metadata only'''
+    parser = ap.ArgumentParser(prog='pysang scan',
+                               description='List sample and run metadata of ABI files',
+                               formatter_class=ap.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('inputs', nargs='+',
+                        help='ABI files or folders with .ab1 files')
+    parser.add_argument('--format', choices=['csv', 'json'], default='csv',
+                        help='Output format')
+    parser.add_argument('-o', '--output', default='-',
+                        help='Output file, - for stdout')
+    parser.add_argument('-j', '--processes', type=int, default=None,
+                        help='Number of worker processes (default: available cores)')
+
+    args = parser.parse_args(argv)
+
+    import os
+    from batch import find_abi_files, write_scans
+    filenames = []
+    for path in args.inputs:
+        if os.path.isdir(path):
+            filenames.extend(find_abi_files(path))
+        else:
+            filenames.append(path)
+
+    if args.output == '-':
+        n_errors = write_scans(filenames, sys.stdout, fmt=args.format,
+                               processes=args.processes)
+    else:
+        with open(args.output, 'w') as out:
+            n_errors = write_scans(filenames, out, fmt=args.format,
+                                   processes=args.processes)
+
+    if n_errors:
+        sys.stderr.write('pysang: %d of %d files could not be scanned\n' %
+                         (n_errors, len(filenames)))
+        sys.exit(1)
+
+
+commands = {'batch': main_batch,
+            'benchmark': main_benchmark,
+            'render': main_render,
+            'scan': main_scan}
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    if argv and (argv[0] in commands):
+        commands[argv[0]](argv[1:])
+        return
+
     parser = ap.ArgumentParser(description='PySang - Sanger chromatograph viewer',
-                               formatter_class=ap.ArgumentDefaultsHelpFormatter)    
+                               epilog='Headless subcommands: '+', '.join(sorted(commands))+
+                                      ' (see pysang <subcommand> -h)',
+                               formatter_class=ap.ArgumentDefaultsHelpFormatter)
     parser.add_argument('--version', action='store_true',
                         help='Print version and exit')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     print_version = args.version
 
     if print_version:
-        from pkg_resources import require
-        print require('PySang')[0].version
+        from info import version
+        print version
         sys.exit()
 
     from gui import main as main_gui
@@ -5,6 +5,17 @@ date:       13/12/13
 content:    GUI for Sanger chromatographs, GUI library hub.
 '''
 # Functions
+def load_chromatograph(filename):
+    '''Parse a file and prepare its first plot, safe to run off the UI thread'''
+    from parser import parse_abi
+    from cache import default_cache
+    from plot import trace_pyramid
+
+    seq = parse_abi(filename, compact=True, cache=default_cache())
+    trace_pyramid(seq)
+    return seq
+
+
 def main():
 
     try:
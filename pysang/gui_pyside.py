@@ -5,22 +5,31 @@ date:       10/12/13
 content:    GUI interface for Sanger chromatographs, using PySide (QT).
 '''
 # Modules
+import os
 import sys
+from Queue import Queue, Empty
 import matplotlib
 matplotlib.use('Qt4Agg')
 matplotlib.rcParams['backend.qt4'] = 'PySide'
 from matplotlib.backends.backend_qt4agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.figure import Figure
 from PySide import QtCore, QtGui
+import numpy as np
 
 from parser import parse_abi
-from plot import plot_chromatograph, closest_peak, peak_position, highlight_base
+from gui import load_chromatograph
+from plot import plot_chromatograph, update_chromatograph, closest_peak, \
+        peak_position, highlight_base, base_markers
 from sequence_utils import reverse_complement
+from tiles import TileRenderer, TileCache, tile_count, tiles_to_render
 from info import aboutMessage
 
 
 # Globals
 window_refs = []
+# running file loaders, kept here so that they outlive the window that
+# started them
+loader_refs = []
 
 
 
@@ -35,6 +44,9 @@ class SingleChromCanvas(FigureCanvas):
         self.fig.set_facecolor(self.rgba_to_zeroone(QtGui.QColor(QtGui.QPalette.Background).toTuple()))
         self.axes = self.fig.add_subplot(111)
 
+        # Background for blitting animated artists (e.g. base highlight)
+        self.background = None
+        self.mpl_connect('draw_event', self.cacheBackground)
 
         FigureCanvas.setSizePolicy(self,
                                    QtGui.QSizePolicy.Expanding,
@@ -42,12 +54,259 @@ class SingleChromCanvas(FigureCanvas):
         FigureCanvas.updateGeometry(self)
 
 
+    def animatedArtists(self):
+        return [a for a in self.axes.get_children() if a.get_animated()]
+
+
+    def cacheBackground(self, event=None):
+        '''Store the axes without animated artists, then draw those on top'''
+        self.background = self.copy_from_bbox(self.axes.bbox)
+        for artist in self.animatedArtists():
+            self.axes.draw_artist(artist)
+
+
+    def blitAnimated(self):
+        '''Redraw only the animated artists over the cached background'''
+        if self.background is None:
+            self.draw()
+            return
+        self.restore_region(self.background)
+        for artist in self.animatedArtists():
+            self.axes.draw_artist(artist)
+        self.blit(self.axes.bbox)
+
+
     @staticmethod
     def rgba_to_zeroone(rgba):
         return tuple(1.0 - 1.0 * c / 255.0 for c in rgba)
 
 
 
+class TileWorker(QtCore.QThread):
+    '''Render tiles of a chromatograph in a worker thread.
+
+    Requests are (generation, seq, markers, indices); only the latest request
+    is served, so tiles scrolled past are never rendered late. The markers of
+    the base labels are built in the UI thread, see plot.base_markers.
+    '''
+    tileReady = QtCore.Signal(int, int)
+
+    def __init__(self, cache, parent=None):
+        QtCore.QThread.__init__(self, parent)
+        self.cache = cache
+        self.requests = Queue()
+        self.renderer = None
+        self.generation = None
+
+
+    def request(self, generation, seq, markers, indices):
+        self.requests.put((generation, seq, markers, indices))
+
+
+    def stop(self):
+        self.requests.put(None)
+        self.wait()
+
+
+    def run(self):
+        while True:
+            request = self.requests.get()
+            # skip to the latest request
+            while request is not None:
+                try:
+                    request = self.requests.get_nowait()
+                except Empty:
+                    break
+            if request is None:
+                return
+
+            (generation, seq, markers, indices) = request
+            if generation != self.generation:
+                self.renderer = TileRenderer(seq, tile_width=TileStrip.tileWidth,
+                                             px_per_unit=TileStrip.pxPerUnit,
+                                             height=TileStrip.tileHeight,
+                                             markers=markers)
+                self.generation = generation
+
+            for index in indices:
+                # a newer request changes the priorities
+                if not self.requests.empty():
+                    break
+                if (generation, index) in self.cache:
+                    continue
+                image = self.renderer.render(index)
+                # QImage.Format_ARGB32 is BGRA in memory on little-endian machines
+                bgra = np.ascontiguousarray(image[:, :, [2, 1, 0, 3]])
+                qimage = QtGui.QImage(bgra.data, bgra.shape[1], bgra.shape[0],
+                                      QtGui.QImage.Format_ARGB32).copy()
+                self.cache.put((generation, index), qimage,
+                               nbytes=qimage.byteCount())
+                self.tileReady.emit(generation, index)
+
+
+
+class TileStrip(QtGui.QAbstractScrollArea):
+    '''Scrollable strip of the whole read, composited from cached tiles.
+
+    Tiles are rendered off the UI thread by a TileWorker, kept in a
+    TileCache, and the neighbours of the visible ones are prefetched.
+    '''
+    tileWidth = 50
+    pxPerUnit = 20
+    tileHeight = 160
+    prefetch = 2
+
+    def __init__(self, parent=None, max_bytes=64 * 2**20):
+        QtGui.QAbstractScrollArea.__init__(self, parent)
+        self.setVerticalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOff)
+        self.setHorizontalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOn)
+        self.setFixedHeight(self.tileHeight + self.horizontalScrollBar().sizeHint().height() +
+                            2 * self.frameWidth())
+
+        self.seq = None
+        self.markers = None
+        self.generation = 0
+        self.n_tiles = 0
+        self.lastRequest = None
+        self.cache = TileCache(max_bytes=max_bytes)
+        self.worker = TileWorker(self.cache, self)
+        self.worker.tileReady.connect(self.tileReady)
+        self.worker.start()
+
+
+    def tilePx(self):
+        return self.tileWidth * self.pxPerUnit
+
+
+    def setSeq(self, seq):
+        '''Show a new sequence, dropping the tiles of the previous one'''
+        self.seq = seq
+        self.generation += 1
+        self.lastRequest = None
+        self.cache.clear()
+        if seq is None:
+            self.n_tiles = 0
+            self.markers = None
+        else:
+            self.n_tiles = tile_count(seq, self.tileWidth)
+            self.markers = base_markers(set(str(seq.seq)))
+        self.updateScrollBar()
+        self.horizontalScrollBar().setValue(0)
+        self.viewport().update()
+
+
+    def updateScrollBar(self):
+        bar = self.horizontalScrollBar()
+        width = self.viewport().width()
+        bar.setRange(0, max(0, self.n_tiles * self.tilePx() - width))
+        bar.setPageStep(width)
+        bar.setSingleStep(self.pxPerUnit)
+
+
+    def visibleTiles(self):
+        offset = self.horizontalScrollBar().value()
+        first = offset // self.tilePx()
+        last = (offset + self.viewport().width() - 1) // self.tilePx()
+        return (first, min(last, self.n_tiles - 1))
+
+
+    def requestTiles(self):
+        '''Ask the worker for missing visible tiles, then their neighbours'''
+        (first, last) = self.visibleTiles()
+        indices = [index for index in tiles_to_render(first, last, self.n_tiles,
+                                                      prefetch=self.prefetch)
+                   if (self.generation, index) not in self.cache]
+        if indices and (indices != self.lastRequest):
+            self.worker.request(self.generation, self.seq, self.markers, indices)
+        self.lastRequest = indices
+
+
+    def tileReady(self, generation, index):
+        if generation != self.generation:
+            return
+        (first, last) = self.visibleTiles()
+        if first <= index <= last:
+            self.viewport().update()
+
+
+    def paintEvent(self, event):
+        painter = QtGui.QPainter(self.viewport())
+        painter.fillRect(self.viewport().rect(), QtCore.Qt.white)
+        if self.seq is None:
+            return
+
+        offset = self.horizontalScrollBar().value()
+        (first, last) = self.visibleTiles()
+        for index in xrange(first, last + 1):
+            x = index * self.tilePx() - offset
+            tile = self.cache.get((self.generation, index))
+            if tile is None:
+                painter.fillRect(x, 0, self.tilePx(), self.tileHeight,
+                                 QtGui.QColor(235, 235, 235))
+            else:
+                painter.drawImage(x, 0, tile)
+        painter.end()
+        self.requestTiles()
+
+
+    def scrollContentsBy(self, dx, dy):
+        self.viewport().update()
+
+
+    def resizeEvent(self, event):
+        QtGui.QAbstractScrollArea.resizeEvent(self, event)
+        self.updateScrollBar()
+
+
+    def wheelEvent(self, event):
+        '''Scroll along the read with the mouse wheel'''
+        bar = self.horizontalScrollBar()
+        bar.setValue(bar.value() - event.delta() * self.pxPerUnit // 40)
+
+
+    def stopWorker(self):
+        self.worker.stop()
+
+
+
+class FileLoader(QtCore.QThread):
+    '''Parse files in a worker thread.
+
+    Results are emitted with the index of their file, each placeholder
+    window is connected to the loader and picks its own.
+    '''
+    loaded = QtCore.Signal(int, object)
+    failed = QtCore.Signal(int, object)
+    progress = QtCore.Signal(int, int)
+
+    def __init__(self, fnames, parent=None):
+        QtCore.QThread.__init__(self, parent)
+        self.fnames = fnames
+        self.stopped = False
+
+
+    def stop(self):
+        '''Skip the files not parsed yet and wait for the thread'''
+        self.stopped = True
+        self.wait()
+
+
+    def run(self):
+        n_files = len(self.fnames)
+        for i, fname in enumerate(self.fnames):
+            if self.stopped:
+                return
+            self.progress.emit(i, n_files)
+            try:
+                seq = load_chromatograph(fname)
+            except Exception as err:
+                self.failed.emit(i, '%s: %s' % (err.__class__.__name__, err))
+            else:
+                self.loaded.emit(i, seq)
+        self.progress.emit(n_files, n_files)
+
+
+
 class ApplicationWindow(QtGui.QMainWindow):
     '''Main window of PySang'''
 
@@ -61,6 +320,7 @@ class ApplicationWindow(QtGui.QMainWindow):
 
         # Menu stuff
         self.initMenuBar()
+        self.initProgressBar()
 
         # Main widget (everything but menu/status bar, and possible dock widgets)
         self.main_widget = QtGui.QWidget(self)
@@ -76,6 +336,11 @@ class ApplicationWindow(QtGui.QMainWindow):
         self.vboxl.addWidget(self.canvas)
         self.initFigure()
 
+        # Scrollable strip of the whole read
+        self.tileStrip = TileStrip(self.main_widget)
+        self.vboxl.addWidget(self.tileStrip)
+        self.tileStrip.setSeq(self.seq)
+
         # Sequence row
         self.initSequenceWidget()
 
@@ -85,6 +350,7 @@ class ApplicationWindow(QtGui.QMainWindow):
         # Button Signal/Slots
         self.goButton.clicked.connect(self.updatePlotRange)
         self.canvas.mpl_connect('button_press_event', self.toggleHighlight)
+        self.enableSeqControls(self.seq is not None)
 
     
     # Initialization functions
@@ -97,10 +363,11 @@ class ApplicationWindow(QtGui.QMainWindow):
         self.menuBar().addMenu(self.fileMenu)
 
         self.viewMenu = QtGui.QMenu('&View', self)
-        self.viewMenu.addAction('&View complete sequence', self.viewViewCompleteSeq,
-                                QtCore.Qt.CTRL + QtCore.Qt.Key_H)
-        self.viewMenu.addAction('&Reverse complement', self.viewReverseComplement,
-                                QtCore.Qt.CTRL + QtCore.Qt.Key_R)
+        self.seqActions = [
+            self.viewMenu.addAction('&View complete sequence', self.viewViewCompleteSeq,
+                                    QtCore.Qt.CTRL + QtCore.Qt.Key_H),
+            self.viewMenu.addAction('&Reverse complement', self.viewReverseComplement,
+                                    QtCore.Qt.CTRL + QtCore.Qt.Key_R)]
         self.menuBar().addMenu(self.viewMenu)
 
         self.helpMenu = QtGui.QMenu('&Help', self)
@@ -109,6 +376,14 @@ class ApplicationWindow(QtGui.QMainWindow):
         self.helpMenu.addAction('&About', self.helpAbout)
 
 
+    def initProgressBar(self):
+        self.loadIndex = None
+        self.progressBar = QtGui.QProgressBar()
+        self.progressBar.setMaximumWidth(200)
+        self.progressBar.hide()
+        self.statusBar().addPermanentWidget(self.progressBar)
+
+
     def initTitleWidget(self):
         self.title = QtGui.QLabel()
         if self.seq is not None:
@@ -121,7 +396,7 @@ class ApplicationWindow(QtGui.QMainWindow):
 
 
     def initFigure(self):
-        plot_chromatograph(self.seq, self.canvas.axes)
+        self.chrom_artists = plot_chromatograph(self.seq, self.canvas.axes)
         self.statusBar().showMessage("Sample data loaded.", 2000)
 
 
@@ -182,28 +457,69 @@ class ApplicationWindow(QtGui.QMainWindow):
             self.range2.insert(str(len(seq)))
 
 
+    def enableSeqControls(self, enabled):
+        '''Enable the range row and the view actions, which need a sequence'''
+        self.range_widget.setEnabled(enabled)
+        for action in self.seqActions:
+            action.setEnabled(enabled)
+
+
+    def updateFigure(self, xlim=None, peaklim=None):
+        '''Update the chromatograph artists in place, plot them if missing'''
+        if self.chrom_artists is None:
+            self.canvas.axes.clear()
+            self.chrom_artists = plot_chromatograph(self.seq, self.canvas.axes,
+                                                    xlim=xlim, peaklim=peaklim)
+        else:
+            update_chromatograph(self.seq, self.canvas.axes, self.chrom_artists,
+                                 xlim=xlim, peaklim=peaklim)
+
+
     def updatePlotRange(self):
+        if (self.seq is None) or (not self.range1.text()) or (not self.range2.text()):
+            return
         start = int(self.range1.text())
         end = int(self.range2.text())
-        self.canvas.axes.clear()
-        plot_chromatograph(self.seq, self.canvas.axes, peaklim=[start, end])
+        self.updateFigure(peaklim=[start, end])
         if hasattr(self, 'hl_base'):
             if not (start <= self.hl_base['index'] < end):
-                del self.hl_base
+                self.clearHighlight()
             else:
-                self.hl_base = highlight_base(self.hl_base['peak'], self.seq, self.canvas.axes)
+                self.highlightBase(self.hl_base['peak'])
         self.setSeqString(self.seq[start: end + 1])
         if hasattr(self, 'hl_base'):
             self.seqText.setCursorPosition(max(0, self.hl_base['index'] - 5))
             self.seqText.repaint()
             self.seqText.setSelection(self.hl_base['index'] - int(self.range1.text()), 1)
-        self.canvas.draw()
+        self.canvas.draw_idle()
+
+
+    def showLoading(self, fname, index):
+        '''Placeholder while file number index of a loader is parsed'''
+        self.loadIndex = index
+        self.title.setText('Loading '+os.path.basename(fname)+'...')
+        self.progressBar.setRange(0, 0)
+        self.progressBar.show()
+        self.statusBar().showMessage('Loading '+fname+'...')
+
+
+    def setSeq(self, seq):
+        '''Show a newly loaded sequence'''
+        self.seq = seq
+        self.title.setText(seq.name)
+        self.setSeqString(seq)
+        self.setSeqRange(seq)
+        self.enableSeqControls(True)
+        self.chrom_artists = None
+        self.updateFigure()
+        self.canvas.draw_idle()
+        self.tileStrip.setSeq(seq)
+        self.progressBar.hide()
+        self.statusBar().showMessage("Data loaded.", 2000)
 
 
     def computeNewFigure(self, seq):
-        self.canvas.axes.clear()
-        plot_chromatograph(self.seq, self.canvas.axes,
-                           xlim=(int(self.range1.text()), int(self.range2.text())))
+        self.updateFigure(xlim=(int(self.range1.text()), int(self.range2.text())))
         self.statusBar().showMessage("New data loaded.", 2000)
 
 
@@ -213,52 +529,93 @@ class ApplicationWindow(QtGui.QMainWindow):
 
 
     def fileOpen(self):
-        fname, _ = QtGui.QFileDialog.getOpenFileName(self, 'Open file')
-        if fname:
-            win = ApplicationWindow(seq=parse_abi(fname))
+        '''Open one new window per file, parsing them in the background'''
+        fnames, _ = QtGui.QFileDialog.getOpenFileNames(self, 'Open files')
+        if not fnames:
+            self.statusBar().showMessage("File not found.", 2000)
+            return
+
+        # the loader has no parent and is referenced globally, so closing
+        # this window or the new ones does not destroy the running thread;
+        # connections to closed windows are dropped by Qt
+        forget_finished_loaders()
+        loader = FileLoader(fnames)
+        for (i, fname) in enumerate(fnames):
+            win = ApplicationWindow()
+            win.showLoading(fname, i)
             window_refs.append(win)
             win.show()
+            loader.loaded.connect(win.fileLoaded)
+            loader.failed.connect(win.fileFailed)
+        loader.progress.connect(self.loadProgress)
+        loader_refs.append(loader)
+        loader.start()
+
 
-            #self.seq = seq = parse_abi(fname)
-            #self.computeNewFigure(seq)
-            #if self.seq is not None:
-            #    self.title.setText(self.seq.name)
-            #self.setSeqString(seq)
-            #self.setSeqRange(seq)
-            #self.canvas.draw()
-            #self.statusBar().showMessage("Data loaded.", 2000)
+    def fileLoaded(self, index, seq):
+        if index == self.loadIndex:
+            self.loadIndex = None
+            self.setSeq(seq)
+
+
+    def fileFailed(self, index, message):
+        if index == self.loadIndex:
+            self.loadIndex = None
+            self.title.setText('Could not load file')
+            self.progressBar.hide()
+            self.statusBar().showMessage(message)
+
+
+    def loadProgress(self, done, total):
+        if done < total:
+            self.progressBar.setRange(0, total)
+            self.progressBar.setValue(done)
+            self.progressBar.show()
+            self.statusBar().showMessage("Loading %d of %d files..." % (done + 1, total))
         else:
-            self.statusBar().showMessage("File not found.", 2000)
+            self.progressBar.hide()
+            self.statusBar().showMessage("Data loaded.", 2000)
 
 
     def viewViewCompleteSeq(self):
+        if self.seq is None:
+            return
         self.setSeqRange(self.seq)
         self.updatePlotRange()
 
 
     def viewReverseComplement(self):
+        if self.seq is None:
+            return
         self.seq = seq = reverse_complement(self.seq)
         self.computeNewFigure(seq)
+        self.tileStrip.setSeq(seq)
         if hasattr(self, 'hl_base'):
             pos_click = peak_position(len(seq) - 1 - self.hl_base['index'], self.seq)
             try:
-                self.hl_base = highlight_base(pos_click, self.seq, self.canvas.axes)
+                self.highlightBase(pos_click)
             except ValueError:
-                del self.hl_base
+                self.clearHighlight()
         self.setSeqString(self.seq[int(self.range1.text()): int(self.range2.text())])
         if hasattr(self, 'hl_base'):
             self.seqText.setCursorPosition(max(0, self.hl_base['index'] - 5))
             self.seqText.repaint()
             self.seqText.setSelection(self.hl_base['index'] - int(self.range1.text()), 1)
-        self.canvas.draw()
+        self.canvas.draw_idle()
         self.statusBar().showMessage("Reverse complement.", 2000)
 
 
     def closeEvent(self, ce):
+        self.tileStrip.stopWorker()
         for iw, win in enumerate(window_refs):
             if win.windex == self.windex:
                 del window_refs[iw]
                 break
+        # the application quits with its last window: stop the loaders
+        if not window_refs:
+            for loader in loader_refs:
+                loader.stop()
+        forget_finished_loaders()
         self.fileQuit()
 
 
@@ -266,22 +623,36 @@ class ApplicationWindow(QtGui.QMainWindow):
         QtGui.QMessageBox.about(self, "About", aboutMessage)
 
 
+    # Highlight
+    def highlightBase(self, pos_click):
+        '''Highlight the base closest to pos_click, reusing the rectangle'''
+        rec = self.hl_base['rec'] if hasattr(self, 'hl_base') else None
+        self.hl_base = highlight_base(pos_click, self.seq, self.canvas.axes,
+                                      rec=rec)
+        self.hl_base['rec'].set_animated(True)
+
+
+    def clearHighlight(self):
+        self.hl_base['rec'].remove()
+        del self.hl_base
+
+
     # Other events
     def toggleHighlight(self, ev):
         '''Toggle highlight of a base if it's clicked'''
-        if ev.inaxes != self.canvas.axes:
+        if (self.seq is None) or (ev.inaxes != self.canvas.axes):
             return
 
-        if hasattr(self, 'hl_base'):
-            self.hl_base['rec'].remove()
-            if self.hl_base['index'] == closest_peak(ev.xdata, self.seq)['index']:
-                del self.hl_base
-                return
+        if hasattr(self, 'hl_base') and \
+           (self.hl_base['index'] == closest_peak(ev.xdata, self.seq)['index']):
+            self.clearHighlight()
+            self.canvas.blitAnimated()
+            return
         try:
-            self.hl_base = highlight_base(ev.xdata, self.seq, self.canvas.axes)
+            self.highlightBase(ev.xdata)
         except ValueError:
             return
-        self.canvas.draw()
+        self.canvas.blitAnimated()
 
         if hasattr(self, 'hl_base'):
             self.seqText.setCursorPosition(max(0, self.hl_base['index'] - 5))
@@ -290,10 +661,16 @@ class ApplicationWindow(QtGui.QMainWindow):
 
 
 
+# Functions
+def forget_finished_loaders():
+    '''Drop the references to loaders whose thread has ended'''
+    loader_refs[:] = [loader for loader in loader_refs if loader.isRunning()]
+
+
 def main():
     from pkg_resources import resource_stream
     input_file = resource_stream(__name__, 'data/FZ01_A12_096.ab1')
-    seq = parse_abi(input_file)
+    seq = parse_abi(input_file, compact=True)
 
     app = QtGui.QApplication.instance()
     if app is None:
@@ -5,7 +5,10 @@ date:       13/12/13
 content:    GUI interface for Sanger chromatographs, using Tk.
 '''
 # Modules
+import os
 import sys
+import threading
+from Queue import Queue, Empty
 import matplotlib
 matplotlib.use('TkAgg')
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg as FigureCanvas
@@ -14,6 +17,7 @@ from Tkinter import *
 import tkFileDialog, tkMessageBox
 
 from parser import parse_abi
+from gui import load_chromatograph
 from plot import plot_chromatograph
 from sequence_utils import reverse_complement
 
@@ -21,6 +25,8 @@ from sequence_utils import reverse_complement
 
 # Globals
 window_refs = []
+# interval for polling background loaders, in ms
+poll_interval = 50
 
 
 
@@ -67,6 +73,27 @@ class MyMplCanvas(FigureCanvas):
 
 
 
+class FileLoader(threading.Thread):
+    '''Parse files in a worker thread, results are put in a queue'''
+    def __init__(self, fnames, windows):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.fnames = fnames
+        self.windows = windows
+        self.results = Queue()
+
+
+    def run(self):
+        for fname, win in zip(self.fnames, self.windows):
+            try:
+                seq = load_chromatograph(fname)
+            except Exception as err:
+                self.results.put((win, None, '%s: %s' % (err.__class__.__name__, err)))
+            else:
+                self.results.put((win, seq, None))
+
+
+
 class ApplicationWindow(Tk):
     def __init__(self, seq=None):
         self.windex = len(window_refs)
@@ -74,6 +101,7 @@ class ApplicationWindow(Tk):
 
         Tk.__init__(self)
         self.title("PySang")
+        self.protocol('WM_DELETE_WINDOW', self.close_window)
 
         # Menu stuff
         menu = Menu(self)
@@ -145,6 +173,8 @@ class ApplicationWindow(Tk):
         self.statusBar = Label(master=self, text="Data loaded", bd=1, relief=SUNKEN, anchor=W)
         self.statusBar.pack(side=BOTTOM, fill=X)
 
+        self.enable_seq_controls(seq is not None)
+
 
     def integerValidator(self, text):
         '''Check that the empty string or a positive integer has been entered'''
@@ -177,8 +207,18 @@ class ApplicationWindow(Tk):
             self.range2.insert(END, str(len(seq)))
 
 
+    def enable_seq_controls(self, enabled):
+        '''Enable the range row and reverse complement, which need a sequence'''
+        state = NORMAL if enabled else DISABLED
+        for widget in (self.range1, self.range2, self.goButton):
+            widget.config(state=state)
+        self.options_menu.entryconfig('Reverse complement', state=state)
+
+
     def update_plot(self):
         '''Update plot according to ranges'''
+        if (self.seq is None) or (not self.range1.get()) or (not self.range2.get()):
+            return
         r1 = int(self.range1.get())
         r2 = int(self.range2.get())
         self.canvas.update_plot_range(r1, r2)
@@ -190,17 +230,49 @@ class ApplicationWindow(Tk):
 
 
     def fileOpen(self, event=None):
-        '''Open a new window loading from a file'''
-        fname = tkFileDialog.askopenfilename()
-        if fname:
-            win = ApplicationWindow(seq=parse_abi(fname))
-            window_refs.append(win)
-        else:
+        '''Open one new window per file, parsing them in the background'''
+        fnames = tkFileDialog.askopenfilenames()
+        if isinstance(fnames, basestring):
+            fnames = self.tk.splitlist(fnames)
+        if not fnames:
             self.statusBar.config(text="File not found.")
+            return
+
+        windows = []
+        for fname in fnames:
+            win = ApplicationWindow()
+            win.show_loading(fname)
+            window_refs.append(win)
+            windows.append(win)
+
+        loader = FileLoader(fnames, windows)
+        loader.n_done = 0
+        loader.opener = self
+        loader.start()
+        self.statusBar.config(text="Loading 1 of %d files..." % len(fnames))
+        schedule_poll(loader)
+
 
+    def show_loading(self, fname):
+        '''Placeholder while the file is parsed in the background'''
+        self.titlew.config(text='Loading '+os.path.basename(fname)+'...')
+        self.statusBar.config(text='Loading '+fname+'...')
+
+
+    def set_seq(self, seq):
+        '''Show a newly loaded sequence'''
+        self.seq = seq
+        self.titlew.config(text=seq.name)
+        self.canvas.compute_new_figure(seq)
+        self.enable_seq_controls(True)
+        self.set_seqstring(seq)
+        self.set_seqrange(seq)
+        self.statusBar.config(text="Data loaded")
 
 
     def reverseComplement(self, event=None):
+            if self.seq is None:
+                return
             self.seq = seq = reverse_complement(self.seq)
             self.canvas.compute_new_figure(seq)
             self.set_seqstring(seq)
@@ -208,12 +280,11 @@ class ApplicationWindow(Tk):
             self.statusBar.config(text="Reverse complement.")
 
 
-    def closeEvent(self, ce):
-        for iw, win in enumerate(window_refs):
-            if win.windex == self.windex:
-                del window_refs[iw]
-                break
-        self.fileQuit()
+    def close_window(self):
+        '''Forget and destroy the window, the loaders skip it from now on'''
+        if self in window_refs:
+            window_refs.remove(self)
+        self.destroy()
 
 
     def about(self):
@@ -238,11 +309,55 @@ AND FITNESS FOR A PARTICULAR PURPOSE.
 )
 
 
+
+# Functions
+def schedule_poll(loader):
+    '''Poll a background loader after poll_interval, on any open window'''
+    if window_refs:
+        window_refs[0].after(poll_interval, poll_loader, loader)
+
+
+def poll_loader(loader):
+    '''Show the files parsed by a background loader'''
+    try:
+        while True:
+            try:
+                (win, seq, error) = loader.results.get_nowait()
+            except Empty:
+                break
+            loader.n_done += 1
+            # the window might have been closed while loading
+            if win not in window_refs:
+                continue
+            try:
+                if error is None:
+                    win.set_seq(seq)
+                else:
+                    win.titlew.config(text='Could not load file')
+                    win.statusBar.config(text=error)
+            except TclError:
+                pass
+
+        n_files = len(loader.fnames)
+        if loader.opener in window_refs:
+            try:
+                if loader.n_done < n_files:
+                    loader.opener.statusBar.config(
+                        text="Loading %d of %d files..." % (loader.n_done + 1, n_files))
+                else:
+                    loader.opener.statusBar.config(text="Data loaded.")
+            except TclError:
+                pass
+    finally:
+        if loader.n_done < len(loader.fnames):
+            schedule_poll(loader)
+
+
 def main():
     
     from pkg_resources import resource_stream
     input_file = resource_stream(__name__, 'data/FZ01_A12_096.ab1')
-    seq = parse_abi(input_file)
+    seq = parse_abi(input_file, compact=True)
 
     win = ApplicationWindow(seq)
     window_refs.append(win)
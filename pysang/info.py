@@ -5,6 +5,9 @@ date:       23/12/13
 content:    Information about PySang, utility module.
 '''
 # Globals
+# keep this module free of imports: setup.py and pysang --version read it
+version = '0.3.9'
+
 aboutMessage = """\
 PySang: a Sanger chromatograph viewer.
 
@@ -17,16 +17,20 @@ http://www.appliedbiosystem.com/support/software_community/ABIF_File_Format.pdf
 __docformat__ = "epytext en"
 
 import datetime
+import mmap
 import struct
 
+from collections import deque, namedtuple
+from itertools import izip
 from os.path import basename
 
-from Bio import Alphabet
-from Bio.Alphabet.IUPAC import ambiguous_dna, unambiguous_dna
-from Bio.Seq import Seq
-from Bio.SeqRecord import SeqRecord
+import numpy as np
+
 from Bio._py3k import _bytes_to_string, _as_bytes
 
+from record import ChromatogramRecord, TraceAxis
+from profiling import span
+
 # dictionary for determining which tags goes into SeqRecord annotation
 # each key is tag_name + tag_number
 # if a tag entry needs to be added, just add its key and its key
@@ -81,15 +85,72 @@ _BYTEFMT = {
     19: 's',    # cString
     20: '2i',   # tag, legacy unsupported
 }
+# numpy dtypes for array tags that can be viewed in place
+_NPFMT = {
+    1: 'i1',    # byte
+    3: '>u2',   # word
+    4: '>i2',   # short
+    5: '>i4',   # long
+    7: '>f4',   # float
+    8: '>f8',   # double
+}
+# analyzed trace tags, needed by trim_and_rescale_trace
+_TRACETAGS = frozenset(['PLOC2', 'DATA9', 'DATA10', 'DATA11', 'DATA12'])
+# raw channels, only read when explicitly requested
+_RAWTAGS = frozenset(['DATA1', 'DATA2', 'DATA3', 'DATA4'])
+# tags returned as numpy views over the mapped file in mmap mode
+_VIEWTAGS = _TRACETAGS.union(_RAWTAGS)
 # header data structure (exluding 4 byte ABIF marker)
 _HEADFMT = '>H4sI2H3I'
 # directory data structure
 _DIRFMT = '>4sI2H4I'
-
-
-def AbiIterator(handle, alphabet=None, trim=False):
+# directory data structure as a numpy record, used to decode the whole
+# directory block in one pass
+_DIRDTYPE = np.dtype([
+    ('tag_name', 'S4'),
+    ('tag_number', '>u4'),
+    ('elem_code', '>u2'),
+    ('elem_size', '>u2'),
+    ('elem_num', '>u4'),
+    ('data_size', '>u4'),
+    ('data_offset', '>u4'),
+    ('data_handle', '>u4'),
+])
+# set of tag keys (tag_name + tag_number) that are parsed from directories
+# by default
+_WANTED_TAGS = frozenset(list(_EXTRACT.keys()) + _SPCTAGS).difference(_RAWTAGS)
+_WANTED_NAMES = sorted(set(_as_bytes(key[:4]) for key in _WANTED_TAGS))
+# clipped addition for the cummulative trimming score, and the number of
+# reads from which it is faster to accumulate all of them column by column
+_clip_add = np.frompyfunc(lambda score, base_score: max(score + base_score, 0),
+                          2, 1)
+_CLIP_MIN_ROWS = 32
+
+
+def AbiIterator(handle, alphabet=None, trim=False, use_mmap=False,
+                tags=None, as_arrays=False):
     """Iterator for the Abi file format.
+
+    If use_mmap is True, the file is memory-mapped and the peak positions and
+    the four analyzed channels are read-only big-endian numpy views over the
+    mapping instead of lists of floats. Nothing is copied until the caller
+    converts them (e.g. with .astype(float) or .tolist()). If as_arrays is
+    True, they are the same read-only arrays over the bytes read from the
+    file, without mapping it.
+
+    tags restricts parsing to the given keys (tag_name + tag_number, e.g.
+    ('PBAS2', 'PCON2')), other tags are never read from disk. By default all
+    tags in _EXTRACT and _SPCTAGS except the raw channels DATA1-DATA4 are
+    parsed; raw channels, when requested, go to the 'raw channel N'
+    annotations.
     """
+    # Seq and SeqRecord are only needed here, import them lazily to keep
+    # the import of this module (and of AbiFile) light
+    from Bio import Alphabet
+    from Bio.Alphabet.IUPAC import ambiguous_dna, unambiguous_dna
+    from Bio.Seq import Seq
+    from Bio.SeqRecord import SeqRecord
+
     # raise exception is alphabet is not dna
     if alphabet is not None:
         if isinstance(Alphabet._get_base_alphabet(alphabet),
@@ -114,9 +175,18 @@ def AbiIterator(handle, alphabet=None, trim=False):
     if marker != _as_bytes('ABIF'):
         raise IOError('File should start ABIF, not %r' % marker)
 
+    # map the file, the mapping stays alive as long as any view on it
+    buf = _abi_map(handle) if use_mmap else None
+    as_arrays = as_arrays or use_mmap
+
     # dirty hack for handling time information
     times = {'RUND1': '', 'RUND2': '', 'RUNT1': '', 'RUNT2': '', }
 
+    # defaults for tags left out of the projection
+    seq = ''
+    qual = None
+    sample_id = '<unknown id>'
+
     # initialize annotations
     annot = dict(zip(_EXTRACT.values(), [None] * len(_EXTRACT)))
 
@@ -124,7 +194,10 @@ def AbiIterator(handle, alphabet=None, trim=False):
     header = struct.unpack(_HEADFMT,
                            handle.read(struct.calcsize(_HEADFMT)))
 
-    for tag_name, tag_number, tag_data in _abi_parse_header(header, handle):
+    for tag_name, tag_number, tag_data in _abi_parse_header(header, handle,
+                                                            buf=buf,
+                                                            tags=tags,
+                                                            as_arrays=as_arrays):
         # stop iteration if all desired tags have been extracted
         # 4 tags from _EXTRACT + 2 time tags from _SPCTAGS - 3,
         # and seq, qual, id
@@ -135,23 +208,29 @@ def AbiIterator(handle, alphabet=None, trim=False):
         # PBAS2 is base-called sequence
         if key == 'PBAS2':
             seq = tag_data
-            ambigs = 'KYWMRS'
-            if alphabet is None:
-                if set(seq).intersection(ambigs):
-                    alphabet = ambiguous_dna
-                else:
-                    alphabet = unambiguous_dna
         # PCON2 is quality values of base-called sequence
         elif key == 'PCON2':
             qual = [ord(val) for val in tag_data]
         # PLOC2 is the location of peaks
         elif key == 'PLOC2':
-            peakamps = [float(val) for val in tag_data]
+            if as_arrays:
+                peakamps = tag_data
+            else:
+                peakamps = [float(val) for val in tag_data]
             annot['peak positions'] = peakamps
         # DATA1-DATA4 is raw channel 1-4 output, DATA9-12 the analyzed one
         elif key in ['DATA9', 'DATA10', 'DATA11', 'DATA12']:
-            rawch = [float(val) for val in tag_data]
+            if as_arrays:
+                rawch = tag_data
+            else:
+                rawch = [float(val) for val in tag_data]
             annot['channel '+str(int(key[4:]) - 8)] = rawch
+        elif key in _RAWTAGS:
+            if as_arrays:
+                rawch = tag_data
+            else:
+                rawch = [float(val) for val in tag_data]
+            annot['raw channel '+key[4:]] = rawch
         # FWO_1 is the order of channels in bases
         elif key == 'FWO_1':
             channelorders = tag_data
@@ -166,6 +245,13 @@ def AbiIterator(handle, alphabet=None, trim=False):
             if key in _EXTRACT:
                 annot[_EXTRACT[key]] = tag_data
 
+    ambigs = 'KYWMRS'
+    if alphabet is None:
+        if set(seq).intersection(ambigs):
+            alphabet = ambiguous_dna
+        else:
+            alphabet = unambiguous_dna
+
     # set time annotations
     annot['run_start'] = '%s %s' % (times['RUND1'], times['RUNT1'])
     annot['run_finish'] = '%s %s' % (times['RUND2'], times['RUNT2'])
@@ -176,14 +262,21 @@ def AbiIterator(handle, alphabet=None, trim=False):
     except:
         file_name = ""
 
+    if qual is not None:
+        letter_annot = {'phred_quality': qual}
+    else:
+        letter_annot = None
+
     record = SeqRecord(Seq(seq, alphabet),
                        id=sample_id, name=file_name,
                        description='',
                        annotations=annot,
-                       letter_annotations={'phred_quality': qual})
+                       letter_annotations=letter_annot)
 
     if not trim:
         yield record
+    elif qual is None:
+        raise ValueError('Trimming needs the quality values (PCON2).')
     else:
         yield _abi_trim(record)
 
@@ -194,8 +287,25 @@ def _AbiTrimIterator(handle):
     return AbiIterator(handle, trim=True)
 
 
-def _abi_parse_header(header, handle):
-    """Generator that returns directory contents.
+def _abi_map(handle):
+    """Returns a read-only buffer with the whole file, memory-mapped if possible.
+    """
+    try:
+        fileno = handle.fileno()
+    except (AttributeError, IOError, ValueError):
+        # in-memory handles cannot be mapped, fall back to a single read
+        position = handle.tell()
+        handle.seek(0)
+        data = handle.read()
+        handle.seek(position)
+        return data
+    return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+
+
+def _abi_read_directory(header, handle):
+    """Returns the directory entries as a numpy record array.
+
+    The whole directory block is read at once and decoded in a single pass.
     """
     # header structure (after ABIF marker):
     # file version, tag name, tag number,
@@ -204,41 +314,288 @@ def _abi_parse_header(header, handle):
     head_elem_size = header[4]
     head_elem_num = header[5]
     head_offset = header[7]
-    index = 0
-
-    while index < head_elem_num:
-        start = head_offset + index * head_elem_size
-        # add directory offset to tuple
-        # to handle directories with data size <= 4 bytes
-        handle.seek(start)
-        dir_entry = struct.unpack(_DIRFMT,
-                                  handle.read(struct.calcsize(_DIRFMT))) + (start,)
-        index += 1
-        # only parse desired dirs
-        key = _bytes_to_string(dir_entry[0])
-        key += str(dir_entry[1])
-        if key in (list(_EXTRACT.keys()) + _SPCTAGS):
-            tag_name = _bytes_to_string(dir_entry[0])
-            tag_number = dir_entry[1]
-            elem_code = dir_entry[2]
-            elem_num = dir_entry[4]
-            data_size = dir_entry[5]
-            data_offset = dir_entry[6]
-            tag_offset = dir_entry[8]
-            # if data size <= 4 bytes, data is stored inside tag
-            # so offset needs to be changed
-            if data_size <= 4:
-                data_offset = tag_offset + 20
-            handle.seek(data_offset)
-            data = handle.read(data_size)
-            yield tag_name, tag_number, \
-                _parse_tag_data(elem_code, elem_num, data)
-
-
-def _abi_trim(seq_record):
+
+    handle.seek(head_offset)
+    block = handle.read(head_elem_size * head_elem_num)
+    if len(block) != head_elem_size * head_elem_num:
+        raise IOError('Truncated ABIF directory')
+
+    # entries are normally 28 bytes, but honour the size in the header
+    dtype = np.dtype({'names': _DIRDTYPE.names,
+                      'formats': [_DIRDTYPE.fields[n][0] for n in _DIRDTYPE.names],
+                      'offsets': [_DIRDTYPE.fields[n][1] for n in _DIRDTYPE.names],
+                      'itemsize': head_elem_size})
+    return np.frombuffer(block, dtype=dtype, count=head_elem_num)
+
+
+def _abi_parse_header(header, handle, buf=None, tags=None, as_arrays=False):
+    """Generator that returns directory contents.
+
+    If buf is the mapped file, data is sliced from it rather than read from
+    the handle, and the tags in _VIEWTAGS are returned as numpy views. With
+    as_arrays, they are returned as numpy arrays over the bytes read from the
+    handle. tags is the set of keys to parse, _WANTED_TAGS by default.
+    """
+    if tags is None:
+        tags = _WANTED_TAGS
+        names = _WANTED_NAMES
+    else:
+        tags = frozenset(tags)
+        names = sorted(set(_as_bytes(key[:4]) for key in tags))
+
+    with span('parse.directory'):
+        entries = _abi_read_directory(header, handle)
+
+    # only parse desired dirs, checking the cheap 4-byte names first
+    candidates = np.flatnonzero(np.in1d(entries['tag_name'], names))
+
+    for index in candidates:
+        dir_entry = entries[index]
+        tag_name = _bytes_to_string(dir_entry['tag_name'])
+        tag_number = int(dir_entry['tag_number'])
+        key = tag_name + str(tag_number)
+        if key not in tags:
+            continue
+        elem_code = int(dir_entry['elem_code'])
+        elem_num = int(dir_entry['elem_num'])
+        if (as_arrays or (buf is not None)) and (key in _VIEWTAGS) and \
+           (elem_code in _NPFMT) and (dir_entry['data_size'] > 4):
+            with span('parse.view_tag'):
+                if buf is not None:
+                    tag_data = _view_tag_data(elem_code, elem_num, buf,
+                                              int(dir_entry['data_offset']))
+                else:
+                    data = _abi_read_tag(dir_entry, handle)
+                    tag_data = _view_tag_data(elem_code, elem_num, data, 0)
+        else:
+            with span('parse.read_tag'):
+                data = _abi_read_tag(dir_entry, handle, buf=buf)
+            with span('parse.tag_data'):
+                tag_data = _parse_tag_data(elem_code, elem_num, data)
+        yield tag_name, tag_number, tag_data
+
+
+def _abi_read_tag(dir_entry, handle, buf=None):
+    """Returns the raw bytes of a directory entry.
+
+    dir_entry - record from _abi_read_directory
+    handle - abi file object
+    buf - if not None, buffer with the whole file to slice the data from
+    """
+    data_size = int(dir_entry['data_size'])
+    data_offset = int(dir_entry['data_offset'])
+    # if data size <= 4 bytes, data is stored inside tag
+    # in place of the offset, so it is already in memory
+    if data_size <= 4:
+        return struct.pack('>I', data_offset)[:data_size]
+    elif buf is not None:
+        return buf[data_offset: data_offset + data_size]
+    else:
+        handle.seek(data_offset)
+        return handle.read(data_size)
+
+
+class AbiEntry(namedtuple('AbiEntry', ['name', 'number', 'type', 'elem_size',
+                                         'count', 'size', 'offset'])):
+    """One directory entry: tag name and number, element type code (see
+    _BYTEFMT), element size, number of elements, data size in bytes and data
+    offset. Data of 4 bytes or less are stored in place of the offset."""
+    __slots__ = ()
+
+    @property
+    def key(self):
+        return self.name + str(self.number)
+
+    @property
+    def inline(self):
+        return self.size <= 4
+
+
+class AbiDirectory(object):
+    """Complete ABIF directory as a table, indexed by key.
+
+    The entries are kept as the numpy record array decoded from the file, the
+    columns are exposed as arrays (names, numbers, types, counts, sizes,
+    offsets) and single entries as AbiEntry by key (tag_name + tag_number)
+    in O(1). Any entry, including those parse_abi skips, can be read and
+    decoded on demand:
+
+        with AbiFile('sample.ab1') as abi:
+            for entry in abi.directory.find(name='DATA'):
+                print entry.key, entry.count
+            voltage = abi.directory.decode('EPVt1', abi.handle)
+    """
+
+    def __init__(self, entries, header=None):
+        self.entries = entries
+        self.header = header
+        self._index = dict(
+            (_bytes_to_string(name) + str(number), index)
+            for (index, (name, number)) in enumerate(
+                izip(entries['tag_name'], entries['tag_number'])))
+
+    @classmethod
+    def from_handle(cls, handle):
+        """Read the directory of an open ABIF file"""
+        handle.seek(0)
+        marker = handle.read(4)
+        if marker != _as_bytes('ABIF'):
+            raise IOError('File should start ABIF, not %r' % marker)
+        header = struct.unpack(_HEADFMT,
+                               handle.read(struct.calcsize(_HEADFMT)))
+        with span('parse.directory'):
+            return cls(_abi_read_directory(header, handle), header=header)
+
+    @property
+    def names(self):
+        return self.entries['tag_name']
+
+    @property
+    def numbers(self):
+        return self.entries['tag_number']
+
+    @property
+    def types(self):
+        return self.entries['elem_code']
+
+    @property
+    def counts(self):
+        return self.entries['elem_num']
+
+    @property
+    def sizes(self):
+        return self.entries['data_size']
+
+    @property
+    def offsets(self):
+        return self.entries['data_offset']
+
+    def entry(self, index):
+        """AbiEntry at a row of the table"""
+        e = self.entries[index]
+        return AbiEntry(_bytes_to_string(e['tag_name']), int(e['tag_number']),
+                        int(e['elem_code']), int(e['elem_size']),
+                        int(e['elem_num']), int(e['data_size']),
+                        int(e['data_offset']))
+
+    def __getitem__(self, key):
+        return self.entry(self._index[key])
+
+    def get(self, key, default=None):
+        if key not in self._index:
+            return default
+        return self[key]
+
+    def keys(self):
+        return self._index.keys()
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __iter__(self):
+        for index in xrange(len(self.entries)):
+            yield self.entry(index)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def find(self, name=None, number=None, type=None):
+        """Entries matching all the given name, number and type code"""
+        mask = np.ones(len(self.entries), bool)
+        if name is not None:
+            mask &= self.names == _as_bytes(name)
+        if number is not None:
+            mask &= self.numbers == number
+        if type is not None:
+            mask &= self.types == type
+        return [self.entry(index) for index in np.flatnonzero(mask)]
+
+    def read(self, key, handle):
+        """Raw bytes of an entry, read from the open file"""
+        with span('parse.read_tag'):
+            return _abi_read_tag(self.entries[self._index[key]], handle)
+
+    def decode(self, key, handle):
+        """Value of an entry, decoded with _parse_tag_data"""
+        dir_entry = self.entries[self._index[key]]
+        with span('parse.read_tag'):
+            data = _abi_read_tag(dir_entry, handle)
+        with span('parse.tag_data'):
+            return _parse_tag_data(int(dir_entry['elem_code']),
+                                   int(dir_entry['elem_num']), data)
+
+
+class AbiFile(object):
+    """Lazy reader for ABIF files.
+
+    The directory is indexed on open, each tag is decoded the first time it
+    is accessed and then cached. Keys are tag_name + tag_number:
+
+        with AbiFile('sample.ab1') as abi:
+            sample_id, well = abi['SMPL1'], abi['TUBE1']
+
+    The whole directory is available as an AbiDirectory in abi.directory.
+    """
+
+    def __init__(self, filename):
+        try:
+            self.handle = open(filename, 'rb')
+            self._own_handle = True
+        except TypeError:
+            self.handle = filename
+            self._own_handle = False
+
+        try:
+            self.directory = AbiDirectory.from_handle(self.handle)
+        except:
+            self.close()
+            raise
+        self.header = self.directory.header
+        self._cache = {}
+
+    def __getitem__(self, key):
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+        value = self.directory.decode(key, self.handle)
+        self._cache[key] = value
+        return value
+
+    def get(self, key, default=None):
+        if key not in self.directory:
+            return default
+        return self[key]
+
+    def keys(self):
+        return self.directory.keys()
+
+    def __contains__(self, key):
+        return key in self.directory
+
+    def __iter__(self):
+        return iter(self.directory.keys())
+
+    def __len__(self):
+        return len(self.directory)
+
+    def close(self):
+        if self._own_handle:
+            self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _abi_trim(seq_record, cutoff=0.05, segment=20):
     """Trims the sequence using Richard Mott's modified trimming algorithm.
 
     seq_record - SeqRecord object to be trimmed.
+    cutoff - cutoff value for calculating base score
+    segment - minimum sequence length, shorter sequences are not trimmed
 
     Trimmed bases are determined from their segment score, which is a
     cumulative sum of each base's score. Base scores are calculated from
@@ -248,40 +605,86 @@ def _abi_trim(seq_record):
     http://www.phrap.org/phredphrap/phred.html
     http://www.clcbio.com/manual/genomics/Quality_abif_trimming.html
     """
-
-    start = False   # flag for starting position of trimmed sequence
-    segment = 20    # minimum sequence length
-    trim_start = 0  # init start index
-    cutoff = 0.05   # default cutoff value for calculating base score
-
     if len(seq_record) <= segment:
         return seq_record
+
+    with span('parse.trim'):
+        quals = [seq_record.letter_annotations['phred_quality']]
+        trim_start, trim_finish = trim_many(quals, cutoff=cutoff,
+                                            segment=segment)[0]
+        return seq_record[trim_start:trim_finish]
+
+
+def trim_many(quals, cutoff=0.05, segment=20):
+    """Trim coordinates of many reads at once, see _abi_trim.
+
+    quals - 2D array of quality values, or a list of quality arrays of
+            possibly different lengths
+    cutoff - cutoff value for calculating base score
+    segment - minimum sequence length, shorter sequences are not trimmed
+
+    Returns an (n, 2) integer array of [start, finish) slice coordinates.
+    """
+    if isinstance(quals, np.ndarray) and quals.ndim == 2:
+        quals = quals.astype(float)
+        lengths = np.repeat(quals.shape[1], quals.shape[0])
     else:
-        # calculate base score
-        score_list = [cutoff - (10 ** (qual / -10.0)) for qual in
-                      seq_record.letter_annotations['phred_quality']]
-
-        # calculate cummulative score
-        # if cummulative value < 0, set it to 0
-        # first value is set to 0, because of the assumption that
-        # the first base will always be trimmed out
-        cummul_score = [0]
-        for i in range(1, len(score_list)):
-            score = cummul_score[-1] + score_list[i]
-            if score < 0:
-                cummul_score.append(0)
-            else:
-                cummul_score.append(score)
-                if not start:
-                    # trim_start = value when cummulative score is first > 0
-                    trim_start = i
-                    start = True
+        lengths = np.array([len(qual) for qual in quals], dtype=int)
+        padded = np.zeros((len(lengths), lengths.max() if len(lengths) else 0))
+        for (row, qual) in izip(padded, quals):
+            row[:len(qual)] = qual
+        quals = padded
+    valid = np.arange(quals.shape[1]) < lengths[:, np.newaxis]
+
+    # calculate base score
+    # the first value is set to 0, because of the assumption that
+    # the first base will always be trimmed out
+    scores = cutoff - 10 ** (quals / -10.0)
+    scores[:, :1] = 0
+
+    # the cummulative score is set to 0 whenever it would go below 0; it is
+    # accumulated base by base exactly like the original loop, so that ties
+    # for the highest score resolve to the same (first) index
+    cummul_score = _clipped_cumsum(scores)
+
+    # trim_start = first index where the cummulative score is not reset
+    if quals.shape[1] < 2:
+        trim_start = np.zeros(len(lengths), int)
+    else:
+        started = (cummul_score[:, :-1] + scores[:, 1:] >= 0) & valid[:, 1:]
+        trim_start = np.where(started.any(axis=1), started.argmax(axis=1) + 1, 0)
 
-        # trim_finish = index of highest cummulative score,
-        # marking the end of sequence segment with highest cummulative score
-        trim_finish = cummul_score.index(max(cummul_score))
+    # trim_finish = index of highest cummulative score,
+    # marking the end of sequence segment with highest cummulative score
+    cummul_score[~valid] = -1
+    trim_finish = cummul_score.argmax(axis=1) if quals.shape[1] else lengths
 
-        return seq_record[trim_start:trim_finish]
+    # short sequences are not trimmed
+    short = lengths <= segment
+    trim_start[short] = 0
+    trim_finish[short] = lengths[short]
+
+    return np.column_stack([trim_start, trim_finish])
+
+
+def _clipped_cumsum(scores):
+    """Cumulative sums along rows, set to 0 whenever they would go below 0.
+
+    The sums are accumulated one base at a time in double precision, as in
+    the original trimming loop. Few rows are accumulated as Python floats,
+    many rows one column at a time across all of them.
+    """
+    if scores.shape[1] < 2:
+        return scores.copy()
+    if len(scores) < _CLIP_MIN_ROWS:
+        return _clip_add.accumulate(scores.astype(object), axis=1).astype(float)
+
+    cummul_score = np.empty_like(scores)
+    cummul_score[:, 0] = scores[:, 0]
+    for i in xrange(1, scores.shape[1]):
+        np.add(cummul_score[:, i - 1], scores[:, i], out=cummul_score[:, i])
+        np.maximum(cummul_score[:, i], 0, out=cummul_score[:, i])
+    return cummul_score
 
 
 def _parse_tag_data(elem_code, elem_num, raw_data):
@@ -326,39 +729,136 @@ def _parse_tag_data(elem_code, elem_num, raw_data):
         return None
 
 
+def _view_tag_data(elem_code, elem_num, buf, data_offset):
+    """Returns a read-only numpy view on array data, without copying.
+
+    elem_code - What kind of data
+    elem_num - How many data points
+    buf - buffer with the whole abi file
+    data_offset - Where the data start in buf
+    """
+    view = np.frombuffer(buf, dtype=_NPFMT[elem_code], count=elem_num,
+                         offset=data_offset)
+    view.flags.writeable = False
+    return view
+
+
 def trim_and_rescale_trace(seq):
-    '''Trim traces to peak positions, shift to start from zero, and rescale'''
+    '''Trim traces to peak positions, shift to start from zero, and rescale
 
-    traces = [seq.annotations['channel '+str(i)] for i in xrange(1, 5)]
-    peaks = seq.annotations['peak positions']
+    The traces are sliced, so numpy views stay views, and the x axis is stored
+    as a TraceAxis instead of a list: the cost does not grow with the trace
+    length. seq can be a SeqRecord or a ChromatogramRecord.
+    '''
+    peaks = np.asarray(seq.annotations['peak positions'], dtype=float)
     n = len(peaks)
-    step = 1.0 * (peaks[-1] - peaks[0]) / n
+    step = (peaks[-1] - peaks[0]) / n
 
-    traces = [[t for (i, t) in enumerate(trace) if peaks[0] <= i < peaks[-1]]
-              for trace in traces]
-    peaks = [(p - peaks[0]) / step for p in peaks]
+    # samples i with peaks[0] <= i < peaks[-1]
+    start = max(0, int(np.ceil(peaks[0])))
+    end = max(start, int(np.ceil(peaks[-1])))
+    peaks = (peaks - peaks[0]) / step
 
-    x = [1.0 * i / step for i in xrange(len(traces[0]))]
+    if isinstance(seq, ChromatogramRecord):
+        seq.traces = seq.traces[:, start: end]
+        seq.peaks = peaks
+        seq.trace_x = TraceAxis(seq.traces.shape[1], step=step)
+        return
 
+    traces = [seq.annotations['channel '+str(i)][start: end]
+              for i in xrange(1, 5)]
     seq.annotations['peak positions'] = peaks
     for (i, trace) in enumerate(traces, 1):
         seq.annotations['channel '+str(i)] = trace
-    seq.annotations['trace_x'] = x
-
+    seq.annotations['trace_x'] = TraceAxis(len(traces[0]), step=step)
+
+
+
+def parse_abi(filename, trim=True, use_mmap=False, compact=False, tags=None,
+              cache=None):
+    '''Parse an ABI file from Sanger sequencing
+
+    With use_mmap=True the traces and peak positions are numpy views over the
+    memory-mapped file (see AbiIterator). With compact=True a
+    ChromatogramRecord is returned instead of a SeqRecord, built from the
+    typed tag data whether or not the file is mapped. tags restricts the
+    tags read from the file (see AbiIterator), traces are trimmed only if
+    they are among them. cache is an optional RecordCache for full records
+    parsed from a file name.
+    '''
+    if (cache is not None) and (tags is None):
+        with span('parse.cache_get'):
+            seq = cache.get(filename, trim=trim, compact=compact)
+        if seq is not None:
+            return seq
+
+    with span('parse.abif'):
+        try:
+            with open(filename, 'rb') as abifile:
+                seq = list(AbiIterator(abifile, use_mmap=use_mmap,
+                                       tags=tags, as_arrays=compact))[0]
+        except TypeError:
+            abifile = filename
+            seq = list(AbiIterator(abifile, use_mmap=use_mmap, tags=tags,
+                                   as_arrays=compact))[0]
+
+    if trim and ((tags is None) or _TRACETAGS.issubset(tags)):
+        with span('parse.rescale'):
+            trim_and_rescale_trace(seq)
+
+    if compact:
+        with span('parse.compact'):
+            seq = ChromatogramRecord.from_seqrecord(seq)
+
+    if (cache is not None) and (tags is None):
+        with span('parse.cache_put'):
+            cache.put(filename, seq, trim=trim)
+    return seq
 
 
-def parse_abi(filename, trim=True):
-    '''Parse an ABI file from Sanger sequencing'''
-    try:
-        with open(filename, 'rb') as abifile:
-            seq = list(AbiIterator(abifile))[0]
-    except TypeError:
-        abifile = filename
-        seq = list(AbiIterator(abifile))[0]
-
-    if trim:
-        trim_and_rescale_trace(seq)
-    return seq
+def parse_abi_many(filenames, trim=True, pool=None, readahead=4, **kwargs):
+    '''Parse many ABI files, yielding one record at a time
+
+    filenames - iterable of file names or open handles
+    pool - optional pool with apply_async (e.g. a
+           multiprocessing.pool.ThreadPool) to overlap file I/O and decoding
+    readahead - with a pool, at most readahead - 1 parses run ahead while
+                the caller holds the last record yielded, so at most
+                readahead records are alive at once; with readahead 1 no
+                file is parsed before the next record is requested
+
+    Other keyword arguments are passed to parse_abi. Without a pool, or with
+    readahead 1, the files are parsed lazily, one by one.
+    '''
+    if readahead < 1:
+        raise ValueError('readahead must be at least 1')
+
+    if (pool is None) or (readahead == 1):
+        for filename in filenames:
+            yield parse_abi(filename, trim=trim, **kwargs)
+        return
+
+    kwargs['trim'] = trim
+    filenames = iter(filenames)
+    pending = deque()
+    exhausted = False
+    while True:
+        # the record yielded last may still be held by the caller
+        while (not exhausted) and (len(pending) < readahead - 1):
+            try:
+                filename = next(filenames)
+            except StopIteration:
+                exhausted = True
+                break
+            pending.append(pool.apply_async(parse_abi, (filename,), kwargs))
+
+        if not pending:
+            return
+
+        seq = pending.popleft().get()
+        yield seq
+        # drop our reference before reading ahead again
+        del seq
 
 
 
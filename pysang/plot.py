@@ -5,17 +5,37 @@ date:       09/12/13
 content:    Plot functions for Sanger chromatographs.
 '''
 # Modules
+from bisect import bisect_left, bisect_right
 from collections import defaultdict
 from itertools import izip
+from weakref import WeakKeyDictionary
+
+import numpy as np
+
+from record import TraceAxis
+from profiling import span
 
 # Globals
 bases = ['A', 'C', 'G', 'T']
 colors = defaultdict(lambda: 'purple', {'A': 'r', 'C': 'b', 'G': 'g', 'T': 'k'})
+# coarsest level of the trace pyramids, in bins
+_PYRAMID_MIN_BINS = 256
+# base labels: height in units of the font size, and y position
+_LABEL_SIZE = 0.8
+_LABEL_Y = -0.1
+# resize callback of each axes, replaced when the axes are plotted again
+_resize_cids = WeakKeyDictionary()
 
 
 # Functions
 def plot_chromatograph(seq, ax=None, xlim=None, peaklim=None):
-    '''Plot Sanger chromatograph'''
+    '''Plot Sanger chromatograph
+
+    Returns the artists as a dict with 'traces' (Line2D per base) and
+    'labels' (one collection of base calls per letter), to be reused by
+    update_chromatograph. Labels are hidden when they would overlap, and the
+    traces are decimated again to the resolution of each zoom or pan.
+    '''
 
     if ax is None:
         import matplotlib.pyplot as plt
@@ -27,58 +47,343 @@ def plot_chromatograph(seq, ax=None, xlim=None, peaklim=None):
         ax.set_ylim(-0.15, 1.05)
         return
 
+    with span('plot.data'):
+        data = _chromatograph_data(seq, ax, xlim=xlim, peaklim=peaklim)
+    if data is None:
+        return
+
+    # Plot traces
+    with span('plot.traces'):
+        artists = {'traces': {}, 'view': _view_state(seq, data)}
+        for base in data['bases']:
+            artists['traces'][base] = ax.plot(data['x'], data['y'][base],
+                                              color=colors[base], lw=2,
+                                              label=base)[0]
+
+    # Plot bases at peak positions
+    with span('plot.labels'):
+        artists['labels'] = _plot_base_labels(data, ax)
+
+    with span('plot.axes'):
+        ax.set_ylim(ymin=-0.15, ymax=1.05)
+        ax.set_xlim(*data['xlim'])
+        ax.set_yticklabels([])
+        ax.grid()
+        ax.legend(loc='upper left', bbox_to_anchor=(0.95, 1.0))
+        _connect_view_callbacks(ax, artists)
+    return artists
+
+
+def update_chromatograph(seq, ax, artists, xlim=None, peaklim=None):
+    '''Update the artists of plot_chromatograph to a new sequence or range
+
+    Lines are updated in place with set_data, so no artist is rebuilt
+    except the few base label collections of the new window.
+    '''
+    with span('plot.data'):
+        data = _chromatograph_data(seq, ax, xlim=xlim, peaklim=peaklim)
+
+    for label in artists['labels']:
+        label.remove()
+
+    if data is None:
+        for line in artists['traces'].itervalues():
+            line.set_data([], [])
+        artists['labels'] = []
+        artists['view'] = None
+        return artists
+
+    artists['view'] = _view_state(seq, data)
+
+    with span('plot.traces'):
+        for base in data['bases']:
+            artists['traces'][base].set_data(data['x'], data['y'][base])
+    with span('plot.labels'):
+        artists['labels'] = _plot_base_labels(data, ax)
+    with span('plot.axes'):
+        ax.set_xlim(*data['xlim'])
+        _update_label_visibility(ax, artists)
+    return artists
+
+
+def _chromatograph_data(seq, ax, xlim=None, peaklim=None):
+    '''Normalized traces, peaks and bases in a window, None if empty'''
+
     # Get signals
     traces = [seq.annotations['channel '+str(i)] for i in xrange(1, 5)]
     peaks = seq.annotations['peak positions']
     bases = seq.annotations['channels']
     x = seq.annotations['trace_x']
+    with span('plot.pyramid'):
+        pyramid = trace_pyramid(seq)
 
     # Limit to a region if necessary
+    start, end = 0, len(x)
     if (xlim is not None) or (peaklim is not None):
         if peaklim is not None:
             xlim = (peaks[min(len(peaks) - 1, peaklim[0])],
                     peaks[min(len(peaks) - 1, peaklim[1] - 1)])
-        ind = [(xi >= xlim[0]) and (xi <= xlim[1]) for xi in x]
-        if not any(ind):
-            return 
 
-        x = [xi for (indi, xi) in izip(ind, x) if indi]
-        traces = [[ci for (indi, ci) in izip(ind, tr) if indi] for tr in traces]
-        ind = [i for (i, ti) in enumerate(peaks) if (ti >= xlim[0]) and (ti <= xlim[1])]
-        peaks = peaks[ind[0]: ind[-1] + 1]
-        seq = seq[ind[0]: ind[-1] + 1]
+        # x and peaks are sorted, so the window is found by binary search
+        start = bisect_left(x, xlim[0])
+        end = bisect_right(x, xlim[1])
+        peak_start = bisect_left(peaks, xlim[0])
+        peak_end = bisect_right(peaks, xlim[1])
+        if (start >= end) or (peak_start >= peak_end):
+            return
 
-    # Plot traces
-    trmax = max(map(max, traces))
-    for base in bases:
-        y = [1.0 * ci / trmax for ci in traces[bases.index(base)]]
-        ax.plot(x, y, color=colors[base], lw=2, label=base)
+        peaks = peaks[peak_start: peak_end]
+        seq = seq[peak_start: peak_end]
+
+    # Decimate to the resolution of the axes if there are many samples
+    level = _decimation_level(end - start, ax, len(pyramid) - 1)
+    (xw, traces) = _window_traces(traces, pyramid, level, x, start, end)
+
+    # Normalize traces
+    trmax = max(np.max(tr) for tr in traces)
+    y = dict((base, np.asarray(traces[bases.index(base)], dtype=float) / trmax)
+             for base in bases)
+
+    pad = max(2, 0.02 * (peaks[-1] - peaks[0]))
+    return {'x': xw, 'y': y, 'bases': bases, 'peaks': peaks, 'seq': seq,
+            'xlim': (peaks[0] - pad, peaks[-1] + pad),
+            'window': (start, end), 'level': level, 'trmax': trmax}
+
+
+def _view_state(seq, data):
+    '''What _update_decimation needs to decimate the plotted window again'''
+    (start, end) = data['window']
+    return {'seq': seq, 'window': (start, end), 'trmax': data['trmax'],
+            'shown': (data['level'], start, end)}
+
+
+def _window_traces(traces, pyramid, level, x, start, end):
+    '''x values and traces for samples [start, end) at a pyramid level'''
+    if level:
+        return _decimated_traces(pyramid[level], level, x, start, end)
+    return (x[start: end], [tr[start: end] for tr in traces])
+
+
+def _update_decimation(ax, artists):
+    '''Decimate the traces again for the current x limits of the axes.
+
+    The samples in view, plus one view width on each side for panning, are
+    taken from the pyramid level matching the resolution of the axes. Lines
+    are updated with set_data, and only if the level changes or the view
+    leaves the samples already shown.
+    '''
+    view = artists.get('view')
+    if view is None:
+        return
+
+    seq = view['seq']
+    x = seq.annotations['trace_x']
+    (wstart, wend) = view['window']
+    (xmin, xmax) = sorted(ax.get_xlim())
+    start = max(wstart, bisect_left(x, xmin))
+    end = min(wend, bisect_right(x, xmax))
+    if start >= end:
+        return
+
+    pyramid = trace_pyramid(seq)
+    level = _decimation_level(end - start, ax, len(pyramid) - 1)
+    (shown_level, shown_start, shown_end) = view['shown']
+    if (level == shown_level) and (shown_start <= start) and (end <= shown_end):
+        return
+
+    width = end - start
+    (start, end) = (max(wstart, start - width), min(wend, end + width))
+    traces = [seq.annotations['channel '+str(i)] for i in xrange(1, 5)]
+    with span('plot.decimate'):
+        (xw, traces) = _window_traces(traces, pyramid, level, x, start, end)
+        bases = seq.annotations['channels']
+        for (base, line) in artists['traces'].iteritems():
+            line.set_data(xw, np.asarray(traces[bases.index(base)], dtype=float) /
+                          view['trmax'])
+    view['shown'] = (level, start, end)
 
-    # Plot bases at peak positions
-    for i, peak in enumerate(peaks):
-        ax.text(peak, -0.11, seq[i], color=colors[seq[i]],
-                horizontalalignment='center')
 
-    ax.set_ylim(ymin=-0.15, ymax=1.05)
-    ax.set_xlim(xmin=peaks[0] - max(2, 0.02 * (peaks[-1] - peaks[0])),
-                xmax=peaks[-1] + max(2, 0.02 * (peaks[-1] - peaks[0])))
-    ax.set_yticklabels([])
-    ax.grid()
-    ax.legend(loc='upper left', bbox_to_anchor=(0.95, 1.0))
+def base_markers(letters):
+    '''Scatter markers of the base letters, by letter.
+
+    The markers are mathtext, which is not thread-safe: threads drawing base
+    labels get markers built in the GUI thread.
+    '''
+    from matplotlib.markers import MarkerStyle
+
+    return dict((letter, MarkerStyle(r'$\mathrm{%s}$' % letter))
+                for letter in letters)
+
+
+def _plot_base_labels(data, ax, markers=None):
+    '''Plot the called bases at their peak positions, one collection per base
+
+    Each letter is a scatter marker, so a full read is drawn as a handful of
+    collections instead of one Text artist per base. markers are from
+    base_markers, built here if missing.
+    '''
+    from matplotlib import rcParams
+
+    (peaks, seq) = (np.asarray(data['peaks']), str(data['seq'].seq))
+    letters = np.fromstring(seq, dtype='S1')
+    size = (_LABEL_SIZE * rcParams['font.size'])**2
+    if markers is None:
+        markers = base_markers(set(seq))
+
+    labels = []
+    for letter in sorted(set(seq)):
+        pos = peaks[letters == letter]
+        labels.append(ax.scatter(pos, np.repeat(_LABEL_Y, len(pos)),
+                                 s=size, marker=markers[letter],
+                                 c=colors[letter], linewidths=0,
+                                 label='_nolegend_'))
+    return labels
+
+
+def _update_label_visibility(ax, artists):
+    '''Hide the base labels if they would overlap at the current zoom'''
+    from matplotlib import rcParams
+
+    labels = artists['labels']
+    if not labels:
+        return
+
+    peaks = np.sort(np.concatenate([lab.get_offsets()[:, 0] for lab in labels]))
+    (xmin, xmax) = sorted(ax.get_xlim())
+    peaks = peaks[(peaks >= xmin) & (peaks <= xmax)]
+    if len(peaks) < 2:
+        visible = True
+    else:
+        # typical spacing of the peaks vs the width of a letter, in pixels
+        width = ax.get_window_extent().width
+        spacing = np.median(np.diff(peaks)) * width / (xmax - xmin)
+        label_width = (_LABEL_SIZE * rcParams['font.size'] *
+                       ax.figure.dpi / 72.0)
+        visible = spacing >= label_width
+
+    for label in labels:
+        label.set_visible(visible)
+
+
+def _connect_view_callbacks(ax, artists):
+    '''Update the trace decimation and the base label visibility when
+    zooming, panning or resizing'''
+    def callback(*args):
+        _update_decimation(ax, artists)
+        _update_label_visibility(ax, artists)
+
+    ax.callbacks.connect('xlim_changed', callback)
+    canvas = ax.figure.canvas
+    if canvas is not None:
+        if ax in _resize_cids:
+            canvas.mpl_disconnect(_resize_cids[ax])
+        _resize_cids[ax] = canvas.mpl_connect('resize_event', callback)
+    _update_label_visibility(ax, artists)
+
+
+def trace_pyramid(seq):
+    '''Min/max pyramid of the four traces, cached on the record.
+
+    Level k > 0 holds the minimum and maximum of each channel over bins of
+    2**k samples, as a pair of (4, ceil(N / 2**k)) arrays. Level 0 is None.
+    '''
+    if hasattr(seq, 'traces'):
+        source = (seq.traces,)
+    else:
+        source = tuple(seq.annotations['channel '+str(i)] for i in xrange(1, 5))
+
+    # the traces are compared by identity, so a hit copies nothing
+    cached = getattr(seq, '_trace_pyramid', None)
+    if (cached is not None) and all(a is b for (a, b) in izip(cached[0], source)):
+        return cached[1]
+
+    if len(source) == 1:
+        traces = np.asarray(source[0])
+    else:
+        traces = np.array(source)
+
+    levels = [None]
+    (mins, maxs) = (traces, traces)
+    while mins.shape[1] > _PYRAMID_MIN_BINS:
+        if mins.shape[1] % 2:
+            mins = np.hstack([mins, mins[:, -1:]])
+            maxs = np.hstack([maxs, maxs[:, -1:]])
+        mins = np.minimum(mins[:, 0::2], mins[:, 1::2])
+        maxs = np.maximum(maxs[:, 0::2], maxs[:, 1::2])
+        levels.append((mins, maxs))
+
+    seq._trace_pyramid = (source, levels)
+    return levels
+
+
+def _decimation_level(n_samples, ax, max_level):
+    '''Pyramid level giving 2-4 points per pixel column of the axes'''
+    width = max(1.0, ax.get_window_extent().width)
+    if n_samples <= 2 * width:
+        return 0
+    return min(max_level, int(np.log2(n_samples / width)))
+
+
+def _decimated_traces(level_data, level, x, start, end):
+    '''x values and min/max-interleaved traces for samples [start, end)'''
+    (mins, maxs) = level_data
+    binsize = 2**level
+    (bin_start, bin_end) = (start // binsize, (end - 1) // binsize + 1)
+
+    traces = np.empty((4, 2 * (bin_end - bin_start)), dtype=mins.dtype)
+    traces[:, 0::2] = mins[:, bin_start: bin_end]
+    traces[:, 1::2] = maxs[:, bin_start: bin_end]
+
+    # each bin spans from its first to its last sample
+    ind = np.empty(2 * (bin_end - bin_start), int)
+    ind[0::2] = np.arange(bin_start, bin_end) * binsize
+    ind[1::2] = ind[0::2] + binsize - 1
+    ind = ind.clip(start, end - 1)
+    if isinstance(x, TraceAxis):
+        x = (ind - x.offset) / x.step
+    else:
+        x = np.array([x[i] for i in ind])
+    return (x, traces)
 
 
 def closest_peak(pos_click, seq):
+    '''Index and position of the peak closest to pos_click.
+
+    Peak positions are sorted, so this is a binary search. Ties go to the
+    lower index.
+    '''
     peaks = seq.annotations['peak positions']
-    (i, peak) = min(enumerate(peaks), key=lambda x: abs(x[1] - pos_click))
-    return {'index': i, 'peak': peak}
+    i = bisect_left(peaks, pos_click)
+    if (i == len(peaks)) or ((i > 0) and
+                             (pos_click - peaks[i - 1] <= peaks[i] - pos_click)):
+        # first of possibly repeated positions
+        i = bisect_left(peaks, peaks[i - 1])
+    return {'index': i, 'peak': peaks[i]}
+
+
+def closest_peaks(positions, seq):
+    '''Indices of the peaks closest to many positions at once, see closest_peak'''
+    peaks = np.asarray(seq.annotations['peak positions'], dtype=float)
+    positions = np.asarray(positions, dtype=float)
+    if len(peaks) == 1:
+        return np.zeros(positions.shape, int)
+
+    ind = np.searchsorted(peaks, positions).clip(1, len(peaks) - 1)
+    ind -= (positions - peaks[ind - 1]) <= (peaks[ind] - positions)
+    # first of possibly repeated positions
+    return np.searchsorted(peaks, peaks[ind])
 
 
 def peak_position(i, seq):
     return seq.annotations['peak positions'][i]
 
 
-def highlight_base(pos_click, seq, ax):
-    '''Highlight the area around a peak with a rectangle'''
+def highlight_base(pos_click, seq, ax, rec=None):
+    '''Highlight the area around a peak with a rectangle
+
+    If rec is a rectangle from a previous call, it is moved instead of adding
+    a new one.
+    '''
 
     trace = seq.annotations['channel 1']
     peaks = seq.annotations['peak positions']
@@ -103,10 +408,13 @@ def highlight_base(pos_click, seq, ax):
 
     ymin, ymax = ax.get_ylim()
 
-    from matplotlib.patches import Rectangle
-    rec = Rectangle((xmin, ymin), (xmax - xmin), (ymax - ymin),
-                    edgecolor='none', facecolor='blue', alpha=0.3)
-    ax.add_patch(rec)
+    if rec is None:
+        from matplotlib.patches import Rectangle
+        rec = Rectangle((xmin, ymin), (xmax - xmin), (ymax - ymin),
+                        edgecolor='none', facecolor='blue', alpha=0.3)
+        ax.add_patch(rec)
+    else:
+        rec.set_bounds(xmin, ymin, (xmax - xmin), (ymax - ymin))
     return {'index': i, 'peak': peak, 'rec': rec}
 
 
@@ -0,0 +1,157 @@
+# vim: fdm=indent
+'''
+author:     Fabio Zanini
+date:       17/10/26
+content:    Opt-in timing of the parsing and plotting hot paths.
+
+            Profiling is off by default. Enable it with the PYSANG_PROFILE
+            environment variable or with enable(). If PYSANG_PROFILE_OUTPUT
+            is set too, the JSON summary is written there at exit.
+'''
+# Modules
+import os
+import json
+import atexit
+from collections import defaultdict
+from timeit import default_timer
+
+
+# Globals
+_enabled = bool(os.environ.get('PYSANG_PROFILE'))
+# span name -> list of durations in seconds
+_samples = defaultdict(list)
+_PERCENTILES = (50, 90, 99)
+
+
+
+# Classes
+class _Span(object):
+    '''Context manager recording the duration of a block'''
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+
+    def __enter__(self):
+        self.start = default_timer()
+        return self
+
+
+    def __exit__(self, *args):
+        _samples[self.name].append(default_timer() - self.start)
+
+
+
+class _NoSpan(object):
+    '''Context manager doing nothing, used when profiling is off'''
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        pass
+
+
+
+_no_span = _NoSpan()
+
+
+
+# Functions
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def span(name):
+    '''Time a block under name if profiling is enabled:
+
+        with span('parse.directory'):
+            ...
+    '''
+    if _enabled:
+        return _Span(name)
+    return _no_span
+
+
+def record(name, seconds):
+    '''Add a duration measured elsewhere'''
+    if _enabled:
+        _samples[name].append(seconds)
+
+
+def reset():
+    '''Drop all recorded durations'''
+    _samples.clear()
+
+
+def snapshot():
+    '''Recorded durations as a plain dict, e.g. to send from a worker process'''
+    return dict((name, list(values)) for (name, values) in _samples.iteritems())
+
+
+def merge(samples):
+    '''Add durations from snapshot(), e.g. from a worker process'''
+    for (name, values) in samples.iteritems():
+        _samples[name].extend(values)
+
+
+def summary():
+    '''Count, total, mean, max and percentiles of each span, in seconds'''
+    import numpy as np
+
+    result = {}
+    for (name, values) in _samples.iteritems():
+        if not values:
+            continue
+        values = np.asarray(values)
+        stats = {'count': len(values),
+                 'total': float(values.sum()),
+                 'mean': float(values.mean()),
+                 'max': float(values.max())}
+        for (q, value) in zip(_PERCENTILES, np.percentile(values, _PERCENTILES)):
+            stats['p'+str(q)] = float(value)
+        result[name] = stats
+    return result
+
+
+def format_summary(stats=None):
+    '''Table of the summary, slowest spans first, times in ms'''
+    if stats is None:
+        stats = summary()
+
+    lines = ['%-28s %8s %10s %9s %9s %9s %9s' % ('span', 'count', 'total',
+                                                 'mean', 'p50', 'p90', 'p99')]
+    for name in sorted(stats, key=lambda name: -stats[name]['total']):
+        s = stats[name]
+        lines.append('%-28s %8d %10.2f %9.3f %9.3f %9.3f %9.3f' %
+                     (name, s['count'], 1e3 * s['total'], 1e3 * s['mean'],
+                      1e3 * s['p50'], 1e3 * s['p90'], 1e3 * s['p99']))
+    return '\n'.join(lines)
+
+
+def dump(filename):
+    '''Write the summary as JSON'''
+    with open(filename, 'w') as f:
+        json.dump(summary(), f, indent=2, sort_keys=True)
+
+
+def _dump_at_exit():
+    filename = os.environ.get('PYSANG_PROFILE_OUTPUT')
+    if _samples and filename:
+        dump(filename)
+
+
+atexit.register(_dump_at_exit)
@@ -0,0 +1,269 @@
+# vim: fdm=indent
+'''
+author:     Fabio Zanini
+date:       17/10/26
+content:    Compact array-backed record for Sanger chromatographs.
+'''
+# Modules
+import numpy as np
+
+
+# Globals
+_INT16_MIN, _INT16_MAX = np.iinfo(np.int16).min, np.iinfo(np.int16).max
+
+
+
+# Classes
+class TraceAxis(object):
+    '''Affine x axis of a trace, x[i] = (i - offset) / step.
+
+    It behaves like the list of x values (len, indexing, iteration) without
+    storing it. Use tolist() or numpy.asarray() for the materialized values.
+    '''
+    __slots__ = ('length', 'offset', 'step')
+
+    def __init__(self, length, step=1.0, offset=0.0):
+        self.length = int(length)
+        self.step = float(step)
+        self.offset = float(offset)
+
+
+    def __len__(self):
+        return self.length
+
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, stride = index.indices(self.length)
+            if stride == 1:
+                return TraceAxis(max(0, stop - start), step=self.step,
+                                 offset=self.offset - start)
+            return [self[i] for i in xrange(start, stop, stride)]
+
+        if index < 0:
+            index += self.length
+        if not (0 <= index < self.length):
+            raise IndexError('TraceAxis index out of range')
+        return (index - self.offset) / self.step
+
+
+    def __iter__(self):
+        for i in xrange(self.length):
+            yield (i - self.offset) / self.step
+
+
+    def __array__(self, dtype=None):
+        x = (np.arange(self.length) - self.offset) / self.step
+        if dtype is not None:
+            x = x.astype(dtype)
+        return x
+
+
+    def tolist(self):
+        '''Materialized list of x values'''
+        return list(self)
+
+
+    def __repr__(self):
+        return '%s(length=%d, step=%r, offset=%r)' % \
+                (self.__class__.__name__, self.length, self.step, self.offset)
+
+
+
+def _mate_field(slot):
+    '''Property stored in slot, setting it forgets the cached reverse complement'''
+    def fget(self):
+        return getattr(self, slot)
+
+    def fset(self, value):
+        setattr(self, slot, value)
+        self._forget_mate()
+
+    return property(fget, fset)
+
+
+
+class ChromatogramRecord(object):
+    '''Sanger chromatograph stored in typed numpy arrays.
+
+    The four traces are a single (4, N) array, peak positions and qualities
+    are 1D arrays. The annotations and letter_annotations properties expose
+    the same layout as the SeqRecord returned by parse_abi, as views on the
+    arrays, so the plot and sequence functions accept either.
+
+    The reverse flag is True for the reverse complement of the read as
+    sequenced, see reverse_complement. Assigning the sequence, channels,
+    traces, peaks, qualities or x axis drops the cached reverse complement.
+    '''
+    __slots__ = ('_seq', 'id', 'name', 'description', '_channels',
+                 '_traces', '_peaks', '_quality', '_trace_x', 'metadata',
+                 'reverse', '_mate', '_trace_pyramid')
+
+    seq = _mate_field('_seq')
+    channels = _mate_field('_channels')
+    traces = _mate_field('_traces')
+    peaks = _mate_field('_peaks')
+    quality = _mate_field('_quality')
+    trace_x = _mate_field('_trace_x')
+
+    def __init__(self, seq, traces, peaks, quality, channels,
+                 trace_x=None, id='<unknown id>', name='<unknown name>',
+                 description='', metadata=None):
+        self._mate = None
+        self.seq = seq
+        self.id = id
+        self.name = name
+        self.description = description
+        self.channels = channels
+        self.traces = traces
+        self.peaks = peaks
+        self.quality = quality
+        self.trace_x = trace_x
+        if metadata is None:
+            metadata = {}
+        self.metadata = metadata
+        self.reverse = False
+
+
+    @classmethod
+    def from_seqrecord(cls, seqrecord):
+        '''Build a compact record from a SeqRecord returned by parse_abi'''
+        annotations = seqrecord.annotations
+        traces = _pack_traces([annotations['channel '+str(i)]
+                               for i in xrange(1, 5)])
+        peaks = np.array(annotations['peak positions'], dtype=float)
+        quality = np.array(seqrecord.letter_annotations['phred_quality'],
+                           dtype=np.uint8)
+        trace_x = annotations.get('trace_x', None)
+        if (trace_x is not None) and (not isinstance(trace_x, TraceAxis)):
+            trace_x = np.array(trace_x, dtype=float)
+
+        skip = set(['channel '+str(i) for i in xrange(1, 5)] +
+                   ['peak positions', 'trace_x', 'channels'])
+        metadata = dict((key, value) for (key, value) in annotations.iteritems()
+                        if key not in skip)
+
+        return cls(seqrecord.seq, traces, peaks, quality,
+                   annotations['channels'],
+                   trace_x=trace_x,
+                   id=seqrecord.id, name=seqrecord.name,
+                   description=seqrecord.description,
+                   metadata=metadata)
+
+
+    @property
+    def annotations(self):
+        '''Annotations in the SeqRecord layout, as views on the arrays'''
+        annotations = dict(self.metadata)
+        for i in xrange(4):
+            annotations['channel '+str(i + 1)] = self.traces[i]
+        annotations['peak positions'] = self.peaks
+        annotations['channels'] = self.channels
+        if self.trace_x is not None:
+            annotations['trace_x'] = self.trace_x
+        return annotations
+
+
+    @property
+    def letter_annotations(self):
+        return {'phred_quality': self.quality}
+
+
+    @property
+    def nbytes(self):
+        '''Memory used by the arrays, in bytes'''
+        nbytes = self.traces.nbytes + self.peaks.nbytes + self.quality.nbytes
+        nbytes += getattr(self.trace_x, 'nbytes', 0)
+        return nbytes
+
+
+    def reverse_complement(self):
+        '''Reverse complement, sharing the trace and quality buffers.
+
+        Traces and qualities are reversed views, so only the called sequence
+        and the peak positions are recomputed. The result is cached both ways:
+        the reverse complement of the reverse complement is this record.
+        '''
+        if self._mate is not None:
+            return self._mate
+
+        from Bio.Seq import reverse_complement as rc
+
+        if self.trace_x is not None:
+            tmax = self.trace_x[-1]
+        else:
+            tmax = self.traces.shape[1]
+
+        mate = ChromatogramRecord(self.seq.reverse_complement(),
+                                  self.traces[:, ::-1],
+                                  tmax - self.peaks[::-1],
+                                  self.quality[::-1],
+                                  ''.join(map(rc, self.channels)),
+                                  trace_x=self.trace_x,
+                                  id=self.id, name=self.name,
+                                  description=self.description,
+                                  metadata=self.metadata)
+        mate.reverse = not self.reverse
+        mate._mate = self
+        self._mate = mate
+        return mate
+
+
+    def _forget_mate(self):
+        '''Unlink the cached reverse complement, after the arrays changed'''
+        mate = self._mate
+        if mate is not None:
+            self._mate = None
+            mate._mate = None
+
+
+    def oriented(self, reverse=False):
+        '''This record in the requested orientation, relative to the read'''
+        if bool(reverse) == self.reverse:
+            return self
+        return self.reverse_complement()
+
+
+    def to_seqrecord(self):
+        '''SeqRecord sharing the arrays of this record'''
+        from Bio.SeqRecord import SeqRecord
+        return SeqRecord(self.seq, id=self.id, name=self.name,
+                         description=self.description,
+                         annotations=self.annotations,
+                         letter_annotations=self.letter_annotations)
+
+
+    def __len__(self):
+        return len(self.seq)
+
+
+    def __getitem__(self, index):
+        '''Letters by integer index, SeqRecord slices otherwise'''
+        if isinstance(index, slice):
+            return self.to_seqrecord()[index]
+        return self.seq[index]
+
+
+    def __repr__(self):
+        return '%s(id=%r, name=%r, length=%d, samples=%d)' % \
+                (self.__class__.__name__, self.id, self.name,
+                 len(self), self.traces.shape[1])
+
+
+
+# Functions
+def _pack_traces(traces):
+    '''Stack four traces into a (4, N) array, int16 if no precision is lost'''
+    # typed data from the file (e.g. big-endian int16) need no float pass
+    if all(getattr(trace, 'dtype', None) is not None and
+           trace.dtype.kind in 'iu' and trace.dtype.itemsize <= 2 and
+           len(trace) == len(traces[0]) for trace in traces):
+        traces = np.array(traces)
+        if (not traces.size) or (traces.max() <= _INT16_MAX):
+            return traces.astype(np.int16)
+    traces = np.array(traces, dtype=float)
+    if (traces.size and
+        (traces.min() >= _INT16_MIN) and (traces.max() <= _INT16_MAX) and
+        np.array_equal(traces, np.round(traces))):
+        return traces.astype(np.int16)
+    return traces.astype(np.float32)
@@ -0,0 +1,109 @@
+# vim: fdm=indent
+'''
+author:     Fabio Zanini
+date:       17/10/26
+content:    Headless rendering of chromatograph images in parallel.
+'''
+# Modules
+import os
+
+import numpy as np
+
+from parser import parse_abi
+from batch import imap_ordered
+
+
+# Globals
+# figure, canvas, axes and chromatograph artists of this process, see
+# _init_worker
+_worker = {}
+
+
+
+# Functions
+def _init_worker(width, height, dpi):
+    '''Allocate the figure reused for all files rendered by this process'''
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure(figsize=(width, height), dpi=dpi)
+    _worker['fig'] = fig
+    _worker['canvas'] = FigureCanvasAgg(fig)
+    _worker['ax'] = fig.add_subplot(111)
+    _worker['artists'] = None
+
+
+def _render_one(args):
+    '''Render one file with the figure of this process, errors are returned'''
+    (filename, outdir, fmt, peaklim, thumb_factor, cache) = args
+    from matplotlib.image import imsave
+    from plot import plot_chromatograph, update_chromatograph
+
+    (fig, canvas, ax) = (_worker['fig'], _worker['canvas'], _worker['ax'])
+    prefix = os.path.join(outdir, os.path.splitext(os.path.basename(filename))[0])
+    result = {'filename': filename, 'image': prefix+'.'+fmt,
+              'thumbnail': None, 'error': None}
+    try:
+        seq = parse_abi(filename, compact=True, cache=cache)
+        # after the first file, only the data of the artists change
+        if _worker['artists'] is None:
+            ax.clear()
+            _worker['artists'] = plot_chromatograph(seq, ax, peaklim=peaklim)
+        else:
+            update_chromatograph(seq, ax, _worker['artists'], peaklim=peaklim)
+        ax.set_title(seq.name)
+
+        # draw once, the raster images are written from the same buffer
+        canvas.draw()
+        (width, height) = canvas.get_width_height()
+        image = np.frombuffer(canvas.buffer_rgba(), np.uint8).reshape(height, width, 4)
+        if fmt == 'png':
+            imsave(result['image'], image)
+        else:
+            fig.savefig(result['image'], format=fmt)
+
+        if thumb_factor:
+            result['thumbnail'] = prefix+'.thumb.png'
+            imsave(result['thumbnail'], downsample(image, thumb_factor))
+    except Exception as err:
+        result['error'] = '%s: %s' % (err.__class__.__name__, err)
+    return result
+
+
+def downsample(image, factor):
+    '''Shrink an RGBA image by an integer factor, averaging blocks of pixels'''
+    (height, width, depth) = (image.shape[0] // factor,
+                              image.shape[1] // factor, image.shape[2])
+    image = image[:height * factor, :width * factor]
+    # sum rows, then columns: contiguous reductions are much faster
+    rows = image.reshape(height, factor, -1).sum(axis=1, dtype=np.uint32)
+    total = rows.reshape(height, width, factor, depth).sum(axis=2)
+    return ((total + factor**2 // 2) // factor**2).astype(np.uint8)
+
+
+def render_files(filenames, outdir, fmt='png', peaklim=None, thumb_factor=4,
+                 width=16, height=6, dpi=100, processes=None, cache=None):
+    '''Render chromatographs of many files to images in a process pool.
+
+    fmt - 'png', 'svg' or 'pdf' for the full-size images
+    peaklim - (start, end) base window, the whole read by default
+    thumb_factor - thumbnails are PNGs this many times smaller than the
+                   full-size raster, 0 or None to skip them
+
+    Each process allocates one figure and reuses it and its artists for all
+    its files, and each file is drawn once for both the image and the
+    thumbnail. Results are dicts with filename, image, thumbnail and error,
+    yielded in input order; files that cannot be rendered yield the error
+    instead of raising.
+    '''
+    if fmt not in ('png', 'svg', 'pdf'):
+        raise ValueError('Format not supported: '+str(fmt))
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    tasks = [(filename, outdir, fmt, peaklim, thumb_factor, cache)
+             for filename in filenames]
+    for result in imap_ordered(_render_one, tasks, processes=processes,
+                               initializer=_init_worker,
+                               initargs=(width, height, dpi)):
+        yield result
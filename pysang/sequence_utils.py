@@ -4,9 +4,21 @@ author:     Fabio Zanini
 date:       14/12/13
 content:    Sequence utility functions.
 '''
+# Modules
+from record import ChromatogramRecord
+
+
+
 # Functions
 def reverse_complement(seqrecord):
-    '''Reverse complement a Sanger chromatography SeqRecord including traces.'''
+    '''Reverse complement a Sanger chromatography SeqRecord including traces.
+
+    ChromatogramRecords are reversed as views on the same buffers, and
+    reversing twice returns the original record.
+    '''
+    if isinstance(seqrecord, ChromatogramRecord):
+        return seqrecord.reverse_complement()
+
     from Bio.SeqRecord import SeqRecord
     from Bio.Seq import reverse_complement as rc
 
@@ -0,0 +1,166 @@
+# vim: fdm=indent
+'''
+author:     Fabio Zanini
+date:       17/10/26
+content:    Pre-rendered tiles of chromatographs, for smooth scrolling.
+'''
+# Modules
+import threading
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+
+import numpy as np
+
+from plot import colors, _plot_base_labels
+
+
+# Globals
+_DEFAULT_MAX_BYTES = 64 * 2**20
+
+
+
+# Classes
+class TileRenderer(object):
+    '''Render fixed-width windows of a chromatograph to RGBA images.
+
+    Tile i covers trace_x from x0 + i * tile_width to x0 + (i + 1) * tile_width,
+    where x0 is the first trace position and tile_width is in the units of
+    trace_x (about one base each). Traces are normalized over the whole read
+    and the axes fill the image, so adjacent tiles join seamlessly.
+
+    The renderer owns an Agg figure and must be used by one thread at a time.
+    If that is not the GUI thread, pass the markers of the base labels from
+    plot.base_markers, built in the GUI thread.
+    '''
+
+    def __init__(self, seq, tile_width=50, px_per_unit=20, height=160,
+                 dpi=100, markers=None):
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+        self.seq = seq
+        self.tile_width = tile_width
+        self.x = seq.annotations['trace_x']
+        self.peaks = seq.annotations['peak positions']
+        self.traces = [seq.annotations['channel '+str(i)] for i in xrange(1, 5)]
+        self.bases = seq.annotations['channels']
+        self.markers = markers
+        self.trmax = max(np.max(tr) for tr in self.traces)
+        self.x0 = float(self.x[0])
+        self.n_tiles = tile_count(seq, tile_width)
+
+        self.fig = Figure(figsize=(1.0 * tile_width * px_per_unit / dpi,
+                                   1.0 * height / dpi), dpi=dpi)
+        self.fig.set_facecolor('white')
+        self.canvas = FigureCanvasAgg(self.fig)
+        self.ax = ax = self.fig.add_axes([0, 0, 1, 1])
+        ax.set_axis_off()
+        ax.set_ylim(-0.15, 1.05)
+        self.lines = [ax.plot([], [], color=colors[base], lw=2)[0]
+                      for base in self.bases]
+        self.labels = []
+
+
+    def tile_range(self, index):
+        '''trace_x range covered by a tile'''
+        xmin = self.x0 + index * self.tile_width
+        return (xmin, xmin + self.tile_width)
+
+
+    def render(self, index):
+        '''RGBA image of a tile, as a (height, width, 4) uint8 array'''
+        (xmin, xmax) = self.tile_range(index)
+
+        # one more sample on each side, so lines cross the tile borders
+        start = max(0, bisect_left(self.x, xmin) - 1)
+        end = min(len(self.x), bisect_right(self.x, xmax) + 1)
+        x = np.asarray(self.x[start: end], dtype=float)
+        for (line, trace) in zip(self.lines, self.traces):
+            line.set_data(x, np.asarray(trace[start: end], dtype=float) / self.trmax)
+
+        # labels straddling a border are drawn in both tiles
+        for label in self.labels:
+            label.remove()
+        peak_start = bisect_left(self.peaks, xmin - 0.5)
+        peak_end = bisect_right(self.peaks, xmax + 0.5)
+        if peak_start < peak_end:
+            data = {'peaks': self.peaks[peak_start: peak_end],
+                    'seq': self.seq[peak_start: peak_end]}
+            self.labels = _plot_base_labels(data, self.ax, markers=self.markers)
+        else:
+            self.labels = []
+
+        self.ax.set_xlim(xmin, xmax)
+        self.canvas.draw()
+        (width, height) = self.canvas.get_width_height()
+        return np.frombuffer(self.canvas.buffer_rgba(), np.uint8).reshape(
+                height, width, 4).copy()
+
+
+
+class TileCache(object):
+    '''Thread-safe LRU cache of rendered tiles, bounded in bytes'''
+
+    def __init__(self, max_bytes=_DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._tiles = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def get(self, key):
+        '''Cached tile or None, marking it as recently used'''
+        with self._lock:
+            try:
+                (tile, nbytes) = self._tiles.pop(key)
+            except KeyError:
+                return None
+            self._tiles[key] = (tile, nbytes)
+            return tile
+
+
+    def put(self, key, tile, nbytes=None):
+        '''Store a tile, evicting the least recently used ones if needed'''
+        if nbytes is None:
+            nbytes = tile.nbytes
+        with self._lock:
+            if key in self._tiles:
+                self.nbytes -= self._tiles.pop(key)[1]
+            self._tiles[key] = (tile, nbytes)
+            self.nbytes += nbytes
+            while (self.nbytes > self.max_bytes) and (len(self._tiles) > 1):
+                self.nbytes -= self._tiles.popitem(last=False)[1][1]
+
+
+    def clear(self):
+        with self._lock:
+            self._tiles.clear()
+            self.nbytes = 0
+
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._tiles
+
+
+    def __len__(self):
+        return len(self._tiles)
+
+
+
+# Functions
+def tile_count(seq, tile_width=50):
+    '''Number of tiles covering the trace of a chromatograph'''
+    x = seq.annotations['trace_x']
+    return max(1, int(np.ceil((x[-1] - x[0]) / float(tile_width))))
+
+
+def tiles_to_render(first, last, n_tiles, prefetch=2):
+    '''Indices of the visible tiles first..last, then of their neighbours
+    up to prefetch tiles away, nearest first'''
+    indices = range(max(0, first), min(n_tiles - 1, last) + 1)
+    for distance in xrange(1, prefetch + 1):
+        for index in (last + distance, first - distance):
+            if 0 <= index < n_tiles:
+                indices.append(index)
+    return indices
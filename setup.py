@@ -7,10 +7,16 @@ content:    Setup file for PySang
 import os
 from setuptools import setup, find_packages
 
+# read the version without importing the package
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       'pysang', 'info.py')) as f:
+    version = [line.split("'")[1] for line in f
+               if line.startswith('version = ')][0]
+
 long_description = "Check out the README file for install instructions and more."
 
 setup(name="PySang",
-      version="0.3.9",
+      version=version,
       description="Visualizer for Sanger chromatographs (ABI/AB1).",
       long_description=long_description,
       author="Fabio Zanini",
@@ -0,0 +1,84 @@
+# vim: fdm=indent
+'''
+author:     Fabio Zanini
+date:       17/10/26
+content:    Tests of the vectorized Mott trimming against the original loop.
+'''
+# Modules
+import os
+
+import numpy as np
+
+from pysang.parser import parse_abi, trim_many
+
+
+# Globals
+datafile = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        os.pardir, 'pysang', 'data', 'FZ01_A12_096.ab1')
+
+
+
+# Functions
+def trim_loop(qual, cutoff=0.05, segment=20):
+    '''Trim coordinates from the original loop of _abi_trim'''
+    if len(qual) <= segment:
+        return (0, len(qual))
+    score_list = [cutoff - (10 ** (q / -10.0)) for q in qual]
+    cummul_score = [0]
+    trim_start = 0
+    for i in range(1, len(score_list)):
+        score = cummul_score[-1] + score_list[i]
+        if score < 0:
+            cummul_score.append(0)
+        else:
+            cummul_score.append(score)
+            if not trim_start:
+                trim_start = i
+    return (trim_start, cummul_score.index(max(cummul_score)))
+
+
+def low_quality_reads(n_reads, seed=0):
+    '''Low quality reads with isolated good bases, rich in tied scores'''
+    rng = np.random.RandomState(seed)
+    quals = []
+    for i in xrange(n_reads):
+        qual = rng.randint(0, 12, rng.randint(0, 300))
+        qual[rng.rand(len(qual)) < 0.05] = 20
+        quals.append(list(qual))
+    return quals
+
+
+def check_trim_many(quals):
+    expected = [trim_loop(qual) for qual in quals]
+    assert map(tuple, trim_many(quals)) == expected
+
+
+def test_sample_file():
+    seq = parse_abi(datafile, trim=False)
+    check_trim_many([list(seq.letter_annotations['phred_quality'])])
+
+
+def test_tied_scores():
+    # the highest score is reached twice, the first one must win
+    check_trim_many([[1, 40, 1, 0, 40] + [0] * 30])
+
+
+def test_low_quality_reads():
+    # few reads are accumulated as Python floats, many column by column
+    quals = low_quality_reads(300)
+    check_trim_many(quals[:5])
+    check_trim_many(quals)
+
+
+def test_short_reads():
+    check_trim_many([[40] * 25, [0] * 25, [30], []])
+    check_trim_many([[30]])
+    assert trim_many([]).shape == (0, 2)
+    assert trim_many(np.zeros((5, 1))).tolist() == [[0, 1]] * 5
+    assert trim_many(np.zeros((5, 0))).tolist() == [[0, 0]] * 5
+
+
+def test_array_input():
+    quals = [qual for qual in low_quality_reads(200, seed=1) if len(qual) == 150]
+    quals += [[30] * 150, [1, 40, 1, 0, 40] + [0] * 145]
+    assert (trim_many(np.array(quals)) == trim_many(quals)).all()